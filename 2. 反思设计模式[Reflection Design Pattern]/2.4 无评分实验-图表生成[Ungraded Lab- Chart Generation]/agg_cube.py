@@ -0,0 +1,61 @@
+"""
+预聚合数据立方体 - 常见图表查询的 group-by 结果在加载时算好
+按 coffee_name × year × quarter × month × cash_type 汇总销售额之和与交易笔数，
+以变量 agg 注入生成代码的执行环境；按品类、时间、支付方式作图时只需读取几百行，
+无需每次从逐笔交易重新聚合。sum / count 可加，月度以上的粒度都能由 agg 再汇总得到
+（CSV 追加新行时也只需把新增部分的立方体合并进来，见 merge_agg_cubes）
+"""
+
+import pandas as pd
+
+AGG_DIMENSIONS = ("coffee_name", "year", "quarter", "month", "cash_type")
+VALUE_COLUMN = "price"
+
+# 提示词中对 agg 的说明（生成与反思提示词共用）
+AGG_PROMPT = """DataFrame 'agg' 也已存在：按 coffee_name × year × quarter × month × cash_type 预聚合的结果，只有几百行，其列包括：
+    - coffee_name, year, quarter, month, cash_type（维度，与 df 中同名列一致）
+    - revenue（该组 price 之和）
+    - transactions（该组交易笔数）
+    只涉及上述维度的汇总（例如按品类 / 月份 / 季度 / 支付方式统计销售额或笔数）请直接在 agg 上再聚合，
+    例如 agg.groupby("coffee_name", observed=True)["revenue"].sum()；平均单价 = revenue 之和 / transactions 之和。
+    只有需要逐笔明细（date、time、card、单笔 price 分布）时才使用 df。"""
+
+
+def build_agg_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    从逐笔交易构建预聚合立方体。
+
+    参数:
+        df: load_and_prepare_data 返回的 DataFrame；缺少的维度列会被跳过
+
+    返回:
+        每个维度组合一行的 DataFrame，列为存在的维度 + revenue + transactions
+    """
+    dims = [c for c in AGG_DIMENSIONS if c in df.columns]
+    has_value = VALUE_COLUMN in df.columns
+    if not dims:
+        cube = pd.DataFrame({"transactions": [len(df)]})
+        if has_value:
+            cube.insert(0, "revenue", df[VALUE_COLUMN].sum())
+        return cube
+    grouped = df.groupby(dims, observed=True, sort=True)
+    cube = grouped.size().rename("transactions").to_frame()
+    if has_value:
+        cube.insert(0, "revenue", grouped[VALUE_COLUMN].sum())
+    return cube.reset_index()
+
+
+def merge_agg_cubes(cube: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    """
+    把新增数据的立方体 delta 合并进 cube：revenue / transactions 直接相加，
+    delta 中没有出现的组保持不变。用于追加写入的 CSV 只解析新增部分的场景。
+    """
+    dims = [c for c in AGG_DIMENSIONS if c in cube.columns]
+    if not dims:
+        return cube.add(delta, fill_value=0)
+    merged = pd.concat([cube, delta], ignore_index=True)
+    # 类别不一致时 concat 会退化为 object，这里恢复成分类类型
+    for col in dims:
+        if isinstance(cube[col].dtype, pd.CategoricalDtype):
+            merged[col] = merged[col].astype("category")
+    return merged.groupby(dims, observed=True, sort=True).sum().reset_index()
@@ -0,0 +1,302 @@
+"""
+反思流水线基准 - 在原始与放大 10× / 100× / 1000× 的 coffee_sales.csv 上逐阶段计时
+
+用法（在图表实验目录下运行）:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --scales 1,10 --repeat 5 --json pipeline.json
+    python benchmarks/bench_pipeline.py --json new.json --compare pipeline.json
+
+代码生成使用离线假模型（fake_llm.py）：有录制文件时默认 fake:replay，否则 fake:scripted，
+因此结果不依赖网络。每个阶段报告耗时中位数与该阶段内的峰值 RSS：
+  load_csv      解析 CSV 并派生日期列（不使用 sidecar）
+  load_cached   从 parquet / pickle sidecar 读取
+  agg_cube      构建注入为 agg 的预聚合立方体
+  generate      生成 V1 代码并做执行前静态检查
+  execute       在当前进程内执行绘图代码并以 300 dpi 保存
+  encode        缩放并编码图表，得到反思请求的图片负载
+  preview       预览模式：以 CHART_PREVIEW_DPI 渲染到内存并编码（对应 execute + encode，不写磁盘）
+放大的数据集由原始数据平铺并对 price 加入固定种子的扰动，生成一次后复用。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+
+LAB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAB_DIR)
+
+# 必须在导入 utils 之前设置：关闭响应缓存与追踪导出，绘图使用无界面后端
+os.environ.setdefault("LLM_CACHE", "0")
+os.environ.setdefault("LLM_TRACE_PATH", "")
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import numpy as np
+import pandas as pd
+
+import utils
+import fake_llm
+import chart_workflow
+from code_validator import validate_chart_code, has_errors
+from agg_cube import build_agg_cube
+
+INSTRUCTIONS = [
+    "Plot total revenue by coffee_name as a bar chart.",
+    "Show monthly revenue for each coffee_name as a line chart.",
+    "Compare card vs cash transaction counts per quarter.",
+]
+STAGES = ("load_csv", "load_cached", "agg_cube", "generate", "execute", "encode", "preview")
+DEFAULT_OUT_DIR = os.path.join(LAB_DIR, ".cache", "bench")
+# 与基线相比慢于该比例时在 --compare 中标记
+REGRESSION_THRESHOLD = 0.10
+
+
+# ----------------------------------------------------------------------
+# 内存采样
+# ----------------------------------------------------------------------
+
+def _rss_bytes() -> int | None:
+    # Linux 下读取 /proc，其他平台返回 None 并退回到进程生命周期内的 ru_maxrss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class PeakRss:
+    """在后台线程中每隔 interval 秒采样一次 RSS，记录 with 块内的峰值（字节）。"""
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_bytes() or 0)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if _rss_bytes() is None:
+            self._thread = None
+        else:
+            self.peak = _rss_bytes()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is None:
+            # ru_maxrss 在 Linux 上单位为 KB，在 macOS 上为字节
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak = maxrss if sys.platform == "darwin" else maxrss * 1024
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, _rss_bytes() or 0)
+        return False
+
+
+def timed(samples: dict, stage: str, fn, *args, **kwargs):
+    """执行 fn 并把 (秒数, 峰值 RSS) 记入 samples[stage]，返回 fn 的结果。"""
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    samples.setdefault(stage, []).append((seconds, rss.peak))
+    return result
+
+
+# ----------------------------------------------------------------------
+# 数据集
+# ----------------------------------------------------------------------
+
+def make_scaled_dataset(source: str, factor: int, out_dir: str) -> str:
+    """把 source 平铺 factor 倍写到 out_dir（已存在则直接复用），返回 CSV 路径。"""
+    path = os.path.join(out_dir, f"coffee_sales_x{factor}.csv")
+    if os.path.exists(path):
+        return path
+    os.makedirs(out_dir, exist_ok=True)
+    if factor == 1:
+        shutil.copyfile(source, path)
+        return path
+
+    base = pd.read_csv(source)
+    df = base.iloc[np.tile(np.arange(len(base)), factor)].reset_index(drop=True)
+    rng = np.random.default_rng(factor)
+    df["price"] = (df["price"] * rng.uniform(0.9, 1.1, len(df))).round(2)
+    tmp_path = path + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+# ----------------------------------------------------------------------
+# 基准
+# ----------------------------------------------------------------------
+
+def default_model() -> str:
+    return "fake:replay" if os.path.exists(fake_llm.RECORD_PATH) else "fake:scripted"
+
+
+def bench_scale(csv_path: str, model: str, repeat: int, chart_dir: str) -> dict:
+    samples = {}
+    for _ in range(repeat):
+        timed(samples, "load_csv", utils.load_and_prepare_data, csv_path, use_cache=False)
+    utils.load_and_prepare_data(csv_path)  # 写出 sidecar
+    for _ in range(repeat):
+        df = timed(samples, "load_cached", utils.load_and_prepare_data, csv_path)
+    for _ in range(repeat):
+        agg = timed(samples, "agg_cube", build_agg_cube, df)
+
+    failures = []
+    for i, instruction in enumerate(INSTRUCTIONS):
+        for r in range(repeat):
+            out_path = os.path.join(chart_dir, f"chart_i{i}_r{r}.png")
+
+            def generate():
+                code = chart_workflow.generate_chart_code(instruction, model, out_path)
+                return validate_chart_code(code, out_path)
+
+            code, diagnostics = timed(samples, "generate", generate)
+            if has_errors(diagnostics):
+                failures.append({"instruction": i, "stage": "generate", "error": diagnostics})
+                continue
+            error = timed(samples, "execute", chart_workflow.execute_chart_code, code, df, agg)
+            if error:
+                failures.append({"instruction": i, "stage": "execute", "error": error})
+                continue
+            utils._image_cache.clear()  # 每次都测真实的缩放与编码
+            timed(samples, "encode", utils.prepare_image, out_path)
+
+            def preview():
+                error, image = chart_workflow.render_chart_preview(code, df, agg)
+                return error or utils.prepare_image(image)
+
+            utils._image_cache.clear()
+            outcome = timed(samples, "preview", preview)
+            if isinstance(outcome, str):
+                failures.append({"instruction": i, "stage": "preview", "error": outcome})
+
+    stages = {}
+    for stage in STAGES:
+        runs = samples.get(stage, [])
+        if not runs:
+            continue
+        seconds = [s for s, _ in runs]
+        stages[stage] = {
+            "seconds_median": statistics.median(seconds),
+            "seconds_min": min(seconds),
+            "seconds_max": max(seconds),
+            "samples": len(runs),
+            "peak_rss_mb": round(max(rss for _, rss in runs) / 2**20, 1),
+        }
+    return {
+        "rows": len(df),
+        "csv_mb": round(os.path.getsize(csv_path) / 2**20, 2),
+        "stages": stages,
+        "failures": failures,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=LAB_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict) -> list[dict]:
+    """逐 (scale, stage) 对比中位数耗时，返回 [{"scale", "stage", "baseline_s", "current_s", "change"}]。"""
+    rows = []
+    for scale, result in report["scales"].items():
+        base = baseline.get("scales", {}).get(scale)
+        if base is None:
+            continue
+        for stage, stats in result["stages"].items():
+            before = base["stages"].get(stage)
+            if before is None or not before["seconds_median"]:
+                continue
+            rows.append({
+                "scale": scale,
+                "stage": stage,
+                "baseline_s": before["seconds_median"],
+                "current_s": stats["seconds_median"],
+                "change": stats["seconds_median"] / before["seconds_median"] - 1,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default=os.path.join(LAB_DIR, "coffee_sales.csv"), help="原始数据集")
+    parser.add_argument("--scales", default="1,10,100,1000", help="放大倍数，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=3, help="每个阶段的重复次数")
+    parser.add_argument("--model", help="生成代码使用的模型（默认 fake:replay，无录制时 fake:scripted）")
+    parser.add_argument("--out-dir", default=DEFAULT_OUT_DIR, help="放大数据集与图表的输出目录")
+    parser.add_argument("--json", dest="json_path", help="把结果写入该 JSON 文件")
+    parser.add_argument("--compare", help="与之前写出的 JSON 结果对比")
+    args = parser.parse_args()
+
+    model = args.model or default_model()
+    if not fake_llm.is_fake(model):
+        print(f"⚠️  {model} 不是离线模型，生成阶段的耗时会受网络影响")
+    chart_dir = os.path.join(args.out_dir, "charts")
+    os.makedirs(chart_dir, exist_ok=True)
+
+    report = {
+        "benchmark": "pipeline",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "model": model,
+        "repeat": args.repeat,
+        "instructions": INSTRUCTIONS,
+        "scales": {},
+    }
+    for factor in (int(s) for s in args.scales.split(",")):
+        csv_path = make_scaled_dataset(args.dataset, factor, args.out_dir)
+        result = bench_scale(csv_path, model, args.repeat, chart_dir)
+        report["scales"][f"x{factor}"] = result
+
+        print(f"\nx{factor}：{result['rows']} 行，{result['csv_mb']} MB")
+        print(f"  {'stage':<14}{'median s':>10}{'min s':>10}{'max s':>10}{'n':>5}{'peak RSS':>12}")
+        for stage, stats in result["stages"].items():
+            print(
+                f"  {stage:<14}{stats['seconds_median']:>10.4f}{stats['seconds_min']:>10.4f}"
+                f"{stats['seconds_max']:>10.4f}{stats['samples']:>5}{stats['peak_rss_mb']:>9.1f} MB"
+            )
+        for failure in result["failures"]:
+            print(f"  ✗ 指令 {failure['instruction']} 在 {failure['stage']} 失败：{failure['error']}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            rows = compare(report, json.load(f))
+        report["comparison"] = rows
+        print(f"\n与 {args.compare} 对比（中位数耗时）：")
+        for row in rows:
+            mark = " ⚠️" if row["change"] > REGRESSION_THRESHOLD else ""
+            print(
+                f"  {row['scale']:<7}{row['stage']:<14}{row['baseline_s']:>10.4f} → "
+                f"{row['current_s']:>10.4f}  {row['change']:+.0%}{mark}"
+            )
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✓ 结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+启动耗时基准 - 用 `python -X importtime` 测量导入 main.py 的开销
+
+用法（在图表实验目录下运行）:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --module chart_workflow --repeat 10 --json startup.json
+
+每次都在全新的子进程中导入，报告墙钟时间与 importtime 累计时间的中位数、
+按顶层包汇总的自身导入耗时，以及哪些重量级依赖在启动时就被加载了。
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+
+LAB_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 这些依赖应当在第一次真正使用时才导入
+HEAVY_MODULES = ("google.genai", "openai", "anthropic", "matplotlib", "PIL", "IPython")
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def measure_once(module: str) -> dict:
+    """在子进程中导入一次 module，返回墙钟耗时与 importtime 明细。"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=LAB_DIR,
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            entries.append({"self_us": int(m.group(1)), "cumulative_us": int(m.group(2)), "module": m.group(4)})
+    return {"wall_s": wall, "entries": entries}
+
+
+def summarize(runs: list[dict], module: str, top: int) -> dict:
+    cumulative = []
+    by_package = defaultdict(list)
+    for run in runs:
+        target = next((e for e in run["entries"] if e["module"] == module), None)
+        cumulative.append(target["cumulative_us"] / 1e6 if target else float("nan"))
+        per_run = defaultdict(int)
+        for e in run["entries"]:
+            per_run[e["module"].split(".")[0]] += e["self_us"]
+        for package, us in per_run.items():
+            by_package[package].append(us)
+
+    loaded = {e["module"] for e in runs[-1]["entries"]}
+    packages = sorted(
+        ((p, statistics.median(v) / 1e3) for p, v in by_package.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    return {
+        "module": module,
+        "python": sys.version.split()[0],
+        "repeat": len(runs),
+        "wall_s_median": statistics.median(r["wall_s"] for r in runs),
+        "import_s_median": statistics.median(cumulative),
+        "modules_imported": len(loaded),
+        "heavy_modules_loaded": [m for m in HEAVY_MODULES if m in loaded],
+        "top_packages_ms": [{"package": p, "self_ms": round(ms, 1)} for p, ms in packages[:top]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main", help="要导入的模块（默认 main）")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数，取中位数")
+    parser.add_argument("--top", type=int, default=10, help="列出导入最慢的前 N 个顶层包")
+    parser.add_argument("--json", dest="json_path", help="把结果写入该 JSON 文件")
+    args = parser.parse_args()
+
+    measure_once(args.module)  # 预热 .pyc 与文件系统缓存，不计入结果
+    runs = [measure_once(args.module) for _ in range(args.repeat)]
+    report = summarize(runs, args.module, args.top)
+
+    print(f"import {report['module']}（Python {report['python']}，{report['repeat']} 次中位数）")
+    print(f"  进程墙钟时间：{report['wall_s_median'] * 1000:.0f} ms")
+    print(f"  importtime 累计：{report['import_s_median'] * 1000:.0f} ms，共 {report['modules_imported']} 个模块")
+    heavy = ", ".join(report["heavy_modules_loaded"]) or "无"
+    print(f"  启动时已加载的重量级依赖：{heavy}")
+    print("  按顶层包汇总的自身导入耗时：")
+    for item in report["top_packages_ms"]:
+        print(f"    {item['package']:<24}{item['self_ms']:>8.1f} ms")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✓ 结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+图表结果缓存 - 相同数据集版本 + 指令 + 模型的工作流结果直接复用
+键由数据集内容哈希、规范化后的指令、生成/反思模型与影响结果的参数组成；
+值为整份结果（V1/V2 代码、反馈、各轮记录）连同写过盘的 PNG 内容，
+存放在 ResponseCache 的 SQLite 中，沿用其 TTL 与按条数/字节数的 LRU 淘汰
+"""
+
+import os
+import json
+import base64
+import unicodedata
+
+from response_cache import ResponseCache, make_cache_key
+
+# CHART_CACHE=0 关闭；其余参数与 LLM 响应缓存相互独立
+CHART_CACHE_ENABLED = os.getenv("CHART_CACHE", "1") != "0"
+DEFAULT_CACHE_PATH = os.getenv("CHART_CACHE_PATH", ".cache/chart_results.sqlite")
+DEFAULT_TTL_SECONDS = float(os.getenv("CHART_CACHE_TTL", "0")) or None  # 0 表示永不过期
+DEFAULT_MAX_ENTRIES = int(os.getenv("CHART_CACHE_MAX_ENTRIES", "500"))
+DEFAULT_MAX_BYTES = int(os.getenv("CHART_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# 提示词或结果结构变化时递增，使旧条目失效
+CACHE_VERSION = 1
+
+# 这些字段中的图表路径以 image_basename 开头，命中时改写为本次调用的 basename
+_PATH_FIELDS = {"code_v1", "code_v2", "final_code", "chart_v1", "chart_v2", "final_chart", "code", "chart", "out_path"}
+
+
+def normalize_instruction(instruction: str) -> str:
+    """NFKC 规范化（全角转半角）、合并空白并忽略大小写，措辞相同的指令得到同一个键。"""
+    return " ".join(unicodedata.normalize("NFKC", instruction).split()).casefold()
+
+
+def _rebase(obj, old: str, new: str):
+    if isinstance(obj, dict):
+        return {
+            k: v.replace(old, new) if k in _PATH_FIELDS and isinstance(v, str) else _rebase(v, old, new)
+            for k, v in obj.items()
+        }
+    if isinstance(obj, list):
+        return [_rebase(v, old, new) for v in obj]
+    return obj
+
+
+class ChartResultCache:
+    """
+    run_workflow 结果的持久化缓存。
+
+    参数:
+        path: SQLite 文件路径
+        ttl_seconds: 条目存活时间，None 表示永不过期
+        max_entries: 最多保留的结果数
+        max_bytes: 所有结果（含 base64 图片）的总字节数上限
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        ttl_seconds: float | None = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.store = ResponseCache(path, ttl_seconds=ttl_seconds, max_entries=max_entries, max_bytes=max_bytes)
+
+    @staticmethod
+    def make_key(
+        dataset_fingerprint: str,
+        instruction: str,
+        generation_model: str,
+        reflection_model: str,
+        **options,
+    ) -> str:
+        """
+        参数:
+            dataset_fingerprint: 数据集内容哈希（utils.dataset_fingerprint）
+            instruction: 用户指令，规范化后参与寻址
+            **options: 其他会改变结果的参数，例如 max_rounds / n_candidates
+        """
+        return make_cache_key(
+            "chart", CACHE_VERSION, dataset_fingerprint, normalize_instruction(instruction),
+            generation_model, reflection_model, options,
+        )
+
+    def get(self, key: str, image_basename: str) -> dict | None:
+        """
+        命中时把缓存的图表写到 {image_basename}_v*.png 并返回结果字典（带 cached=True），
+        未命中返回 None。
+        """
+        raw = self.store.get(key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        old, new = f"{entry['image_basename']}_v", f"{image_basename}_v"
+        for path, b64 in entry["images"].items():
+            path = path.replace(old, new)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(b64))
+        result = _rebase(entry["result"], old, new)
+        result["cached"] = True
+        return result
+
+    def set(self, key: str, image_basename: str, result: dict) -> None:
+        """保存一次成功运行的结果；结果中引用且仍在磁盘上的图表一并保存。"""
+        charts = {result.get("chart_v1"), result.get("chart_v2"), result.get("final_chart")}
+        charts.update(r.get("chart") for r in result.get("rounds", []))
+        images = {}
+        for path in charts:
+            if path and os.path.exists(path):
+                with open(path, "rb") as f:
+                    images[path] = base64.b64encode(f.read()).decode("ascii")
+        entry = {
+            "image_basename": image_basename,
+            "result": {k: v for k, v in result.items() if k != "trace_id"},
+            "images": images,
+        }
+        self.store.set(key, json.dumps(entry, ensure_ascii=False))
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+    def clear(self) -> None:
+        self.store.clear()
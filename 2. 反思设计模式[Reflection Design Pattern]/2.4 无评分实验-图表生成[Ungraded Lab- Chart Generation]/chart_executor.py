@@ -0,0 +1,313 @@
+"""
+绘图代码执行器 - 预热的进程池沙箱
+每个工作进程预先导入 pandas / matplotlib（Agg 后端）并持有 DataFrame，
+在 CPU 与墙钟时间限制下执行 LLM 生成的代码，返回 PNG 路径或错误信息；
+预览模式下 savefig 以低 dpi 渲染到内存，直接返回 PNG 字节，不写磁盘
+"""
+
+import io
+import os
+import math
+import re
+import time
+import signal
+import asyncio
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, Future, TimeoutError as FutureTimeoutError
+
+from shared_frame import SharedFrame, attach_frame, shared_layout, copy_on_write_enabled, exec_copy
+from agg_cube import build_agg_cube
+
+try:
+    import resource  # 仅 POSIX 可用
+except ImportError:
+    resource = None
+
+# 默认限制（秒），可通过环境变量覆盖
+DEFAULT_TIME_LIMIT = float(os.getenv("CHART_EXEC_TIME_LIMIT", "60"))
+DEFAULT_CPU_LIMIT = int(os.getenv("CHART_EXEC_CPU_LIMIT", "60"))
+
+# 父进程在工作进程自身的时限之外再额外等待的秒数，超过则认为进程卡死并重建进程池
+WATCHDOG_GRACE = 5.0
+
+# 预览渲染的 dpi：反思请求的图片本就会缩到 utils.REFLECTION_IMAGE_MAX_SIDE 以内，
+# 10×6 英寸的图在 100 dpi 下为 1000×600，无需先按 300 dpi 渲染再缩小
+PREVIEW_DPI = int(os.getenv("CHART_PREVIEW_DPI", "100"))
+
+NO_CODE_ERROR = "No executable code found"
+NO_SAVEFIG_ERROR = "Code ran but did not call savefig"
+
+
+def extract_code(code_with_tags: str) -> str | None:
+    """从 <execute_python>...</execute_python> 中提取代码，未找到返回 None。"""
+    match = re.search(r"<execute_python>([\s\S]*?)</execute_python>", code_with_tags)
+    return match.group(1).strip() if match else None
+
+
+@contextmanager
+def capture_savefig(dpi: int):
+    """
+    在 with 块内把 Figure.savefig（plt.savefig 也经由它）重定向到内存：
+    忽略代码指定的路径、dpi 与格式，按 dpi 渲染为 PNG。
+
+    返回（as 目标）:
+        列表，按顺序收集每次 savefig 得到的 PNG 字节
+    """
+    from matplotlib.figure import Figure
+
+    original = Figure.savefig
+    images = []
+
+    def savefig(self, fname, **kwargs):
+        buf = io.BytesIO()
+        original(self, buf, **{**kwargs, "dpi": dpi, "format": "png"})
+        images.append(buf.getvalue())
+
+    Figure.savefig = savefig
+    try:
+        yield images
+    finally:
+        Figure.savefig = original
+
+
+# ============================================================================
+# 工作进程侧
+# ============================================================================
+
+_worker_df = None
+_worker_agg = None
+
+
+class ChartExecutionTimeout(Exception):
+    """生成代码超出墙钟时间或 CPU 时间限制。"""
+
+
+def _raise_timeout(signum, frame):
+    kind = "CPU" if signum == getattr(signal, "SIGXCPU", None) else "wall-clock"
+    raise ChartExecutionTimeout(f"Chart code exceeded the {kind} time limit")
+
+
+def _init_worker(source, agg) -> None:
+    """
+    工作进程初始化：固定 Agg 后端、预热导入、挂载 DataFrame。
+
+    参数:
+        source: 共享帧的 manifest 路径（零拷贝挂载），或直接传入的 DataFrame
+        agg: 预聚合立方体（只有几 KB，直接随初始化参数传入）
+    """
+    global _worker_df, _worker_agg
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401  预热 pyplot 导入
+    import pandas
+
+    # 工作进程专用于执行生成代码，可以放心打开写时复制（pandas 3 起默认开启），
+    # 这样每次执行只需浅拷贝 df
+    if not copy_on_write_enabled():
+        pandas.set_option("mode.copy_on_write", True)
+
+    # 不共享内存时也按同一布局构建，生成代码看到的 df 与挂载的一致
+    _worker_df = attach_frame(source) if isinstance(source, str) else shared_layout(source)
+    _worker_agg = agg
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+    if hasattr(signal, "SIGXCPU"):
+        signal.signal(signal.SIGXCPU, _raise_timeout)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _arm_limits(time_limit: float, cpu_limit: int) -> None:
+    if hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, time_limit)
+    if resource is not None:
+        # RLIMIT_CPU 按进程累计，因此在当前用量基础上加上本次额度
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = math.ceil(usage.ru_utime + usage.ru_stime)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        soft = used + cpu_limit
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _disarm_limits() -> None:
+    if hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+def _run_in_worker(
+    code: str,
+    out_path: str,
+    time_limit: float,
+    cpu_limit: int,
+    preview_dpi: int | None = None,
+) -> dict:
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    error = None
+    images = None
+    # 写时复制下的浅拷贝：生成代码新增/覆盖列或原地写入都不会影响后续任务
+    exec_globals = {"df": exec_copy(_worker_df), "agg": _worker_agg.copy()}
+    try:
+        # rc_context 保证 rcParams 修改不会泄漏到下一次执行
+        with matplotlib.rc_context():
+            _arm_limits(time_limit, cpu_limit)
+            try:
+                if preview_dpi:
+                    with capture_savefig(preview_dpi) as images:
+                        exec(code, exec_globals)
+                else:
+                    exec(code, exec_globals)
+            finally:
+                _disarm_limits()
+    except (Exception, SystemExit) as e:
+        error = f"{type(e).__name__}: {e}" if isinstance(e, ChartExecutionTimeout) else str(e)
+    finally:
+        plt.close("all")
+
+    if preview_dpi:
+        if error is None and not images:
+            error = NO_SAVEFIG_ERROR
+        return {
+            "ok": error is None,
+            "path": None,
+            "image": images[-1] if error is None else None,
+            "error": error,
+            "elapsed": time.perf_counter() - start,
+        }
+    if error is None and out_path and not os.path.exists(out_path):
+        error = f"Code ran but did not write {out_path}"
+    return {
+        "ok": error is None,
+        "path": out_path if error is None else None,
+        "error": error,
+        "elapsed": time.perf_counter() - start,
+    }
+
+
+# ============================================================================
+# 父进程侧
+# ============================================================================
+
+class ChartExecutor:
+    """
+    预热的绘图代码进程池。
+
+    参数:
+        df: 注入到每次执行中的 DataFrame（变量名 df）
+        max_workers: 工作进程数，默认使用全部 CPU 核心
+        time_limit: 单次执行的墙钟时间上限（秒）
+        cpu_limit: 单次执行的 CPU 时间上限（秒，仅 POSIX 生效）
+        mp_context: multiprocessing 上下文，默认使用平台默认方式
+        share_memory: 为 True 时把 df 导出到共享内存，工作进程零拷贝挂载，
+                      而不是各自接收一份 pickle 副本
+        agg: 注入为 agg 的预聚合立方体，为 None 时由 df 构建（agg_cube.build_agg_cube）
+    """
+
+    def __init__(
+        self,
+        df,
+        max_workers: int | None = None,
+        time_limit: float = DEFAULT_TIME_LIMIT,
+        cpu_limit: int = DEFAULT_CPU_LIMIT,
+        mp_context=None,
+        share_memory: bool = True,
+        agg=None,
+    ):
+        self.df = df
+        self.agg = build_agg_cube(df) if agg is None else agg
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.time_limit = time_limit
+        self.cpu_limit = cpu_limit
+        self.mp_context = mp_context or multiprocessing.get_context()
+        self._shared = SharedFrame(df) if share_memory else None
+        self._pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        source = self._shared.manifest_path if self._shared else self.df
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=self.mp_context,
+            initializer=_init_worker,
+            initargs=(source, self.agg),
+        )
+
+    def warm_up(self) -> None:
+        """提前启动全部工作进程，避免第一批任务承担导入开销。"""
+        futures = [self._pool.submit(_ping) for _ in range(self.max_workers)]
+        for f in futures:
+            f.result()
+
+    def submit(self, code_with_tags: str, out_path: str, preview_dpi: int | None = None) -> Future:
+        """
+        提交一段带标签的代码，立即返回 Future。
+
+        参数:
+            preview_dpi: 设置时为预览模式：不写 out_path，按该 dpi 渲染到内存，
+                         结果中 path 为 None，image 为最后一次 savefig 的 PNG 字节
+
+        返回:
+            Future，结果为 {"ok", "path", "error", "elapsed"} 字典（预览模式另含 "image"）
+        """
+        code = extract_code(code_with_tags)
+        if code is None:
+            future = Future()
+            future.set_result({"ok": False, "path": None, "error": NO_CODE_ERROR, "elapsed": 0.0})
+            return future
+        return self._pool.submit(_run_in_worker, code, out_path, self.time_limit, self.cpu_limit, preview_dpi)
+
+    def run(self, code_with_tags: str, out_path: str, preview_dpi: int | None = None) -> dict:
+        """同步执行，工作进程卡死（信号无法中断）时重建进程池并返回超时错误。"""
+        return self.result(self.submit(code_with_tags, out_path, preview_dpi))
+
+    def result(self, future: Future) -> dict:
+        """等待 submit() 返回的 Future，带与 run() 相同的看门狗。"""
+        try:
+            return future.result(timeout=self.time_limit + WATCHDOG_GRACE)
+        except FutureTimeoutError:
+            self._restart()
+            return self._watchdog_result()
+
+    async def arun(self, code_with_tags: str, out_path: str, preview_dpi: int | None = None) -> dict:
+        """run 的异步版本，供 asyncio 流水线使用。"""
+        future = asyncio.wrap_future(self.submit(code_with_tags, out_path, preview_dpi))
+        try:
+            return await asyncio.wait_for(future, timeout=self.time_limit + WATCHDOG_GRACE)
+        except asyncio.TimeoutError:
+            self._restart()
+            return self._watchdog_result()
+
+    def _watchdog_result(self) -> dict:
+        return {
+            "ok": False,
+            "path": None,
+            "error": f"ChartExecutionTimeout: worker unresponsive after {self.time_limit}s",
+            "elapsed": self.time_limit + WATCHDOG_GRACE,
+        }
+
+    def _restart(self) -> None:
+        # 强制结束卡死的工作进程（其余进行中的任务会收到 BrokenProcessPool）
+        for proc in list((self._pool._processes or {}).values()):
+            proc.kill()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = self._new_pool()
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        if self._shared:
+            self._shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -3,28 +3,34 @@
 实现自我改进的数据可视化生成系统
 """
 
+import os
 import re
+import ast
 import json
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import utils
+import tracing
+from chart_executor import (
+    ChartExecutor, NO_CODE_ERROR, NO_SAVEFIG_ERROR, PREVIEW_DPI, capture_savefig, extract_code,
+)
+from code_validator import validate_chart_code, has_errors, format_diagnostics
+from shared_frame import shared_layout, exec_copy
+from agg_cube import AGG_PROMPT, build_agg_cube
+from chart_cache import ChartResultCache, CHART_CACHE_ENABLED
+
+# 相同 (数据集版本, 指令, 模型, 参数) 的 run_workflow 结果缓存；CHART_CACHE=0 关闭
+result_cache = ChartResultCache()
 
 # ============================================================================
 # 第1部分：代码生成函数
 # ============================================================================
 
-def generate_chart_code(instruction: str, model: str, out_path_v1: str) -> str:
-    """
-    生成使用 matplotlib 绘图的 Python 代码，并用标签包裹返回。
-
-    参数:
-        instruction: 用户对图表的需求描述
-        model: 使用的LLM模型名称
-        out_path_v1: 图表保存路径
-
-    返回:
-        包含在 <execute_python> 标签中的代码字符串
-    """
-
-    prompt = f"""
+def build_generation_prompt(instruction: str, out_path_v1: str) -> str:
+    """构建 V1 代码生成提示词（同步与异步流程共用）。"""
+    return f"""
     你是一位数据可视化专家。
 
     请*严格*按以下格式返回你的答案：
@@ -46,10 +52,12 @@ def generate_chart_code(instruction: str, model: str, out_path_v1: str) -> str:
     - month (1-12)
     - year (YYYY)
 
+    {AGG_PROMPT}
+
     用户指令：{instruction}
 
     代码要求：
-    1. **直接使用已存在的 'df' 变量**，它已经加载了真实数据。
+    1. **直接使用已存在的 'df' / 'agg' 变量**，它们已经加载了真实数据。
     2. **严禁创建示例数据**，不要使用 pd.DataFrame() 创建新的 df。
     3. **严禁重新定义 df 变量**，不要有任何 df = ... 的赋值语句。
     4. 使用 matplotlib 进行绘图。
@@ -62,47 +70,131 @@ def generate_chart_code(instruction: str, model: str, out_path_v1: str) -> str:
     仅返回包含在 <execute_python> 标签中的代码。不要包含任何注释说明需要加载数据。
     """
 
+
+def generate_chart_code(instruction: str, model: str, out_path_v1: str) -> str:
+    """
+    生成使用 matplotlib 绘图的 Python 代码，并用标签包裹返回。
+
+    参数:
+        instruction: 用户对图表的需求描述
+        model: 使用的LLM模型名称
+        out_path_v1: 图表保存路径
+
+    返回:
+        包含在 <execute_python> 标签中的代码字符串
+    """
+    prompt = build_generation_prompt(instruction, out_path_v1)
     response = utils.get_response(model, prompt)
     return response
 
 
-# ============================================================================
-# 第2部分：反思评审函数
-# ============================================================================
-
-def reflect_on_image_and_regenerate(
-    chart_path: str,
+def generate_chart_candidates(
     instruction: str,
-    model_name: str,
-    out_path_v2: str,
-    code_v1: str,
-) -> tuple[str, str]:
+    models: list[str],
+    n: int,
+    image_basename: str,
+) -> list[dict]:
     """
-    根据给定指令评审图表图像与原始代码，然后返回改进后的 matplotlib 代码。
+    并发生成 n 个 V1 候选代码（按顺序轮流使用 models 中的模型）。
 
     参数:
-        chart_path: V1图表的文件路径
-        instruction: 用户的原始需求
-        model_name: 使用的LLM模型名称
-        out_path_v2: V2图表的保存路径
-        code_v1: V1的原始代码（提供上下文）
+        instruction: 用户对图表的需求描述
+        models: 候选模型列表，第 i 个候选使用 models[i % len(models)]
+        n: 候选数量
+        image_basename: 图表文件的基础名称，第 i 个候选保存到 {image_basename}_v1_c{i}.png
 
     返回:
-        (feedback, refined_code_with_tags) 元组
-        - feedback: 对V1的反思反馈
-        - refined_code_with_tags: 改进后的代码（包含标签）
+        候选字典列表，每项包含 model / out_path / code（生成失败时为 error）
     """
-    # 将图表编码为base64
-    media_type, b64 = utils.encode_image_b64(chart_path)
+    candidates = [
+        {"model": models[i % len(models)], "out_path": f"{image_basename}_v1_c{i}.png"}
+        for i in range(n)
+    ]
+
+    def generate(candidate: dict) -> dict:
+        try:
+            candidate["code"] = generate_chart_code(instruction, candidate["model"], candidate["out_path"])
+        except Exception as e:
+            candidate["error"] = str(e)
+        return candidate
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        # 每个候选在提交线程的上下文副本中运行，LLM span 仍挂在当前阶段下
+        futures = [pool.submit(contextvars.copy_context().run, generate, c) for c in candidates]
+        return [f.result() for f in futures]
+
 
-    prompt = f"""
+def score_chart_candidate(code_with_tags: str, chart_path: str | bytes) -> dict:
+    """
+    对已成功执行的候选做廉价的本地检查（不调用 LLM）；chart_path 也可以是预览渲染的 PNG 字节。
+
+    返回:
+        {"score": 总分, "checks": {检查项: 是否通过}}
+    """
+    code = extract_code(code_with_tags) or ""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        tree = ast.Module(body=[], type_ignores=[])
+
+    called = set()
+    uses_df = False
+    fake_frame = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", "")
+            called.add(name)
+            if name == "DataFrame":
+                fake_frame = True
+        elif isinstance(node, ast.Name) and node.id == "df" and isinstance(node.ctx, ast.Load):
+            uses_df = True
+
+    checks = {
+        "file_written": (
+            len(chart_path) > 0 if isinstance(chart_path, bytes)
+            else os.path.exists(chart_path) and os.path.getsize(chart_path) > 0
+        ),
+        "uses_df": uses_df,
+        "no_fake_data": not fake_frame,
+        "has_title": bool(called & {"title", "set_title", "suptitle"}),
+        "has_xlabel": bool(called & {"xlabel", "set_xlabel"}),
+        "has_ylabel": bool(called & {"ylabel", "set_ylabel"}),
+        "has_legend": "legend" in called,
+    }
+    # 数据使用与真实性权重更高，标签/图例属于可读性加分项
+    weights = {"file_written": 3, "uses_df": 3, "no_fake_data": 3,
+               "has_title": 1, "has_xlabel": 1, "has_ylabel": 1, "has_legend": 0.5}
+    score = sum(weights[k] for k, ok in checks.items() if ok)
+    return {"score": score, "checks": checks}
+
+
+# ============================================================================
+# 第2部分：反思评审函数
+# ============================================================================
+
+def build_reflection_prompt(
+    instruction: str,
+    code_v1: str,
+    out_path_v2: str,
+    diagnostics: list[dict] | None = None,
+) -> str:
+    """构建反思提示词（同步与异步流程共用）；diagnostics 为原始代码的静态检查结果。"""
+    if diagnostics:
+        static_notes = f"""
+    执行前静态检查对原始代码发现的问题（已自动修补的也请在改进代码中直接避免）：
+    {format_diagnostics(diagnostics)}
+    """
+    else:
+        static_notes = ""
+    return f"""
     你是一位数据可视化专家。
     你的任务：依据给定指令评审附件中的图表与原始代码，
     并返回改进后的 matplotlib 代码。
 
     原始代码（用于提供上下文）：
     {code_v1}
-
+    {static_notes}
     输出格式（严格遵守！）：
     1) 第一行：仅包含 "feedback" 字段的有效 JSON 对象。
     示例：{{"feedback": "图例不清晰，且坐标轴标签存在重叠。"}}
@@ -117,7 +209,7 @@ def reflect_on_image_and_regenerate(
     强约束：
     - 除上述两部分外，不要包含 Markdown、反引号或任何额外说明文字。
     - 仅使用 pandas/matplotlib（不使用 seaborn）。
-    - **DataFrame 'df' 已经存在并包含真实数据**，直接使用它。
+    - **DataFrame 'df' 与预聚合的 'agg' 已经存在并包含真实数据**，直接使用它们（能用 agg 时优先用 agg）。
     - **严禁创建示例数据**，不要使用 pd.DataFrame() 创建新的 df。
     - **严禁重新定义 df 变量**，不要有任何 df = ... 的赋值语句。
     - 不要从文件读取数据（df 已加载）。
@@ -136,19 +228,20 @@ def reflect_on_image_and_regenerate(
     - month (1-12)
     - year (YYYY)
 
+    {AGG_PROMPT}
+
     指令：
     {instruction}
     """
 
-    # 根据模型类型选择调用方式
-    lower = model_name.lower()
-    if "claude" in lower or "anthropic" in lower:
-        content = utils.image_anthropic_call(model_name, prompt, media_type, b64)
-    elif "gemini" in lower:
-        content = utils.image_gemini_call(model_name, prompt, media_type, b64)
-    else:
-        content = utils.image_openai_call(model_name, prompt, media_type, b64)
 
+def parse_reflection(content: str) -> tuple[str, str]:
+    """
+    解析反思模型的回复：第一行 JSON 反馈 + <execute_python> 代码块。
+
+    返回:
+        (feedback, refined_code_with_tags) 元组
+    """
     # 解析第一行的JSON反馈
     lines = content.strip().splitlines()
     json_line = lines[0].strip() if lines else ""
@@ -175,16 +268,194 @@ def reflect_on_image_and_regenerate(
     return feedback, refined_code
 
 
+def reflect_on_image_and_regenerate(
+    chart_path: str | bytes,
+    instruction: str,
+    model_name: str,
+    out_path_v2: str,
+    code_v1: str,
+    diagnostics: list[dict] | None = None,
+) -> tuple[str, str]:
+    """
+    根据给定指令评审图表图像与原始代码，然后返回改进后的 matplotlib 代码。
+
+    参数:
+        chart_path: V1图表的文件路径，或预览模式下内存中的 PNG 字节
+        instruction: 用户的原始需求
+        model_name: 使用的LLM模型名称
+        out_path_v2: V2图表的保存路径
+        code_v1: V1的原始代码（提供上下文）
+        diagnostics: V1 的静态检查诊断（code_validator），会附在提示词中
+
+    返回:
+        (feedback, refined_code_with_tags) 元组
+        - feedback: 对V1的反思反馈
+        - refined_code_with_tags: 改进后的代码（包含标签）
+    """
+    # 缩放并编码图表（按文件哈希缓存）
+    media_type, image_bytes, b64 = utils.prepare_image(chart_path)
+    prompt = build_reflection_prompt(instruction, code_v1, out_path_v2, diagnostics)
+
+    # 根据模型类型选择调用方式
+    provider = utils.provider_for(model_name)
+    if provider == "fake":
+        content = utils.image_fake_call(model_name, prompt, media_type, b64)
+    elif provider == "anthropic":
+        content = utils.image_anthropic_call(model_name, prompt, media_type, b64)
+    elif provider == "gemini":
+        content = utils.image_gemini_call(model_name, prompt, media_type, b64, image_bytes)
+    else:
+        content = utils.image_openai_call(model_name, prompt, media_type, b64)
+
+    return parse_reflection(content)
+
+
+class ReflectionStreamParser:
+    """
+    增量解析反思模型的流式回复。
+
+    每次 feed() 返回新产生的事件列表：
+        ("feedback_delta", 文本)  反馈 JSON 字符串值的新增部分
+        ("feedback", 完整反馈)    反馈字符串闭合时
+        ("code", 带标签代码)      读到 </execute_python> 时（可立即执行）
+    """
+
+    _FEEDBACK_START = re.compile(r'"feedback"\s*:\s*"')
+    _CODE_BLOCK = re.compile(r"<execute_python>([\s\S]*?)</execute_python>")
+    # 模型常在 JSON 字符串里直接写换行或制表符，按宽松模式解码
+    _STRING_DECODER = json.JSONDecoder(strict=False)
+
+    def __init__(self):
+        self.buffer = ""
+        self.feedback = None
+        self.code = None
+        self._fb_start = None   # 反馈字符串值在 buffer 中的起始位置
+        self._fb_pos = None     # 已输出到的位置
+        self._fb_failed = False # 反馈无法解码时停止增量输出，结束时整段解析
+
+    def feed(self, chunk: str) -> list[tuple[str, str]]:
+        self.buffer += chunk
+        events = []
+        if self.feedback is None:
+            events.extend(self._scan_feedback())
+        if self.code is None:
+            m_code = self._CODE_BLOCK.search(self.buffer)
+            if m_code:
+                self.code = utils.ensure_execute_python_tags(m_code.group(1).strip())
+                events.append(("code", self.code))
+        return events
+
+    def _scan_feedback(self) -> list[tuple[str, str]]:
+        if self._fb_failed:
+            return []
+        if self._fb_start is None:
+            m = self._FEEDBACK_START.search(self.buffer)
+            if not m:
+                return []
+            self._fb_start = self._fb_pos = m.end()
+
+        # 逐字符扫描到未转义的引号为止；不完整的转义序列留到下一个分片
+        i = self._fb_pos
+        closed = False
+        while i < len(self.buffer):
+            ch = self.buffer[i]
+            if ch == "\\":
+                width = 6 if self.buffer[i + 1:i + 2] == "u" else 2
+                if i + width > len(self.buffer):
+                    break
+                i += width
+            elif ch == '"':
+                closed = True
+                break
+            else:
+                i += 1
+
+        events = []
+        try:
+            if i > self._fb_pos:
+                events.append(("feedback_delta", self._decode(self.buffer[self._fb_pos:i])))
+                self._fb_pos = i
+            if closed:
+                self.feedback = self._decode(self.buffer[self._fb_start:i]).strip()
+                events.append(("feedback", self.feedback))
+        except ValueError:
+            # 例如非法转义：放弃增量解析，finish() 会用 parse_reflection 解析整段回复
+            self._fb_failed = True
+        return events
+
+    def _decode(self, raw: str) -> str:
+        return self._STRING_DECODER.decode('"' + raw + '"')
+
+    def finish(self) -> tuple[str, str]:
+        """流结束后返回 (feedback, code)；缺失的部分回退到整段解析。"""
+        if self.feedback is None or self.code is None:
+            feedback, code = parse_reflection(self.buffer)
+            self.feedback = self.feedback if self.feedback is not None else feedback
+            self.code = self.code if self.code is not None else code
+        return self.feedback, self.code
+
+
+def reflect_on_image_and_regenerate_stream(
+    chart_path: str | bytes,
+    instruction: str,
+    model_name: str,
+    out_path_v2: str,
+    code_v1: str,
+    diagnostics: list[dict] | None = None,
+):
+    """
+    reflect_on_image_and_regenerate 的流式版本（生成器）。
+
+    反馈在生成过程中以 ("feedback_delta", 文本) 事件逐段产出；一旦读到
+    </execute_python> 立即产出 ("code", 代码)，调用方可以马上执行 V2，
+    无需等待回复结束。调用方提前关闭生成器时底层连接随之关闭。
+    最后总会产出一个 ("done", (feedback, code)) 事件。
+    """
+    media_type, image_bytes, b64 = utils.prepare_image(chart_path)
+    prompt = build_reflection_prompt(instruction, code_v1, out_path_v2, diagnostics)
+
+    provider = utils.provider_for(model_name)
+    if provider == "fake":
+        chunks = utils.stream_fake_call(model_name, prompt, media_type, b64)
+    elif provider == "anthropic":
+        chunks = utils.stream_anthropic_call(model_name, prompt, media_type, b64)
+    elif provider == "gemini":
+        chunks = utils.stream_gemini_call(model_name, prompt, media_type, b64, image_bytes)
+    else:
+        chunks = utils.stream_openai_call(model_name, prompt, media_type, b64)
+
+    parser = ReflectionStreamParser()
+    try:
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+            if parser.code is not None and parser.feedback is not None:
+                break
+    finally:
+        chunks.close()
+    yield ("done", parser.finish())
+
+
 # ============================================================================
 # 第3部分：完整工作流函数
 # ============================================================================
 
+@tracing.trace_workflow("run_workflow")
 def run_workflow(
     dataset_path: str,
     user_instructions: str,
     generation_model: str,
     reflection_model: str,
     image_basename: str = "chart",
+    executor: ChartExecutor | None = None,
+    df=None,
+    stream: bool = False,
+    max_rounds: int = 1,
+    converge_threshold: float = 0.995,
+    n_candidates: int = 1,
+    candidate_models: list[str] | None = None,
+    validate: bool = True,
+    preview: bool = False,
+    use_cache: bool = True,
 ):
     """
     端到端流水线：
@@ -193,6 +464,7 @@ def run_workflow(
       3) 执行 V1 → 生成 chart_v1.png
       4) 反思 V1（图像 + 原始代码）→ 反馈 + 改进代码
       5) 执行 V2 → 生成 chart_v2.png
+      （max_rounds > 1 时对最新版本重复 4)–5)，直到收敛或达到轮数上限）
 
     参数:
         dataset_path: CSV数据文件路径
@@ -200,91 +472,635 @@ def run_workflow(
         generation_model: 用于生成V1代码的模型
         reflection_model: 用于反思和生成V2的模型
         image_basename: 图表文件的基础名称
+        executor: 可选的 ChartExecutor 进程池；为 None 时在当前进程内执行绘图代码
+        df: 可选的已加载 DataFrame（例如 executor.df），传入时跳过重新读取 CSV
+        stream: 为 True 时流式接收反思结果：反馈边生成边打印，
+                V2 代码块一闭合就提交给 executor 执行
+        max_rounds: 最多反思轮数；第 r 轮输出 {image_basename}_v{r+1}.png
+        converge_threshold: 新旧两版缩略图的像素相似度（utils.image_similarity）达到该值即视为收敛，
+                            反思模型返回与上一版相同的代码时也会提前结束
+        n_candidates: V1 候选数量；大于 1 时并发生成多个候选，丢弃执行失败者，
+                      再用本地检查（是否出图、是否使用 df、标题/坐标轴标签等）选出最佳 V1
+        candidate_models: 候选使用的模型列表（轮流分配），默认只用 generation_model
+        validate: 为 True 时每版代码执行前先做静态检查（code_validator）：
+                  可修补的问题自动修补，无法修补的直接拒绝执行；诊断结果附在下一轮反思提示词中
+        preview: 为 True 时 V1 与中间版本以 PREVIEW_DPI（CHART_PREVIEW_DPI，默认 100）渲染到内存，
+                 不写磁盘、直接送去反思；只有最终采纳的版本按代码中的 dpi=300 写入磁盘
+        use_cache: 为 True（且未设置 CHART_CACHE=0）时先查图表结果缓存：数据集内容、规范化后的指令、
+                   两个模型与上述影响结果的参数都相同时，直接写出缓存的图表并返回（cached=True），
+                   不调用 LLM、不执行代码；成功完成的运行会写入缓存
 
     返回:
-        包含所有产物（代码、反馈、图像路径）的字典
+        包含所有产物（代码、反馈、图像路径）的字典；
+        rounds 记录每轮的反馈/代码/图表/相似度，final_code / final_chart 为最终版本，
+        预览模式下只在内存中渲染过的版本其图表字段为 None，
+        trace_id 对应 tracing 导出的 span（结束时会打印各阶段耗时与 token 汇总）
     """
     print("\n" + "="*70)
     print("🚀 启动反思模式智能体工作流")
     print("="*70)
 
+    cache_key = None
+    if use_cache and CHART_CACHE_ENABLED:
+        with tracing.span("result_cache") as span:
+            cache_key = ChartResultCache.make_key(
+                utils.dataset_fingerprint(dataset_path), user_instructions, generation_model, reflection_model,
+                max_rounds=max_rounds, converge_threshold=converge_threshold, n_candidates=n_candidates,
+                candidate_models=candidate_models, validate=validate,
+            )
+            cached = result_cache.get(cache_key, image_basename)
+            span.set(hit=cached is not None)
+        if cached is not None:
+            print(f"🗃️  命中图表结果缓存，最终图表：{cached['final_chart']}")
+            return cached
+
     # 0) 加载数据集
     print("\n📊 步骤 0：加载数据集...")
-    df = utils.load_and_prepare_data(dataset_path)
+    with tracing.span("load_data"):
+        # 进程池在创建时已构建好自己的 agg，只有在当前进程内执行时才需要
+        if df is None:
+            df = utils.load_and_prepare_data(dataset_path)
+            agg = utils.load_agg_cube(dataset_path, df) if executor is None else None
+        else:
+            agg = build_agg_cube(df) if executor is None else None
+        if executor is None:
+            # 与进程池挂载的共享帧相同的布局，只转换一次，之后每轮执行只做浅拷贝
+            df = shared_layout(df)
     print(f"✓ 数据集加载成功：{len(df)} 行数据")
     print(f"  列名：{', '.join(df.columns.tolist())}")
 
     # 图表保存路径
     out_v1 = f"{image_basename}_v1.png"
     out_v2 = f"{image_basename}_v2.png"
+    # 预览模式下最终版本之前的各版本只在内存中以低 dpi 渲染
+    preview_dpi = PREVIEW_DPI if preview else None
 
-    # 1) 生成代码 (V1)
-    print(f"\n📝 步骤 1：生成绘图代码（V1）...")
-    print(f"  使用模型：{generation_model}")
-    code_v1 = generate_chart_code(
-        instruction=user_instructions,
-        model=generation_model,
-        out_path_v1=out_v1,
-    )
-    print(f"✓ V1代码生成成功（{len(code_v1)} 字符）")
-
-    # 2) 执行 V1
-    print(f"\n💻 步骤 2：执行绘图代码（V1）...")
-    match = re.search(r"<execute_python>([\s\S]*?)</execute_python>", code_v1)
-    if match:
-        initial_code = match.group(1).strip()
-        exec_globals = {"df": df}
-        try:
-            exec(initial_code, exec_globals)
-            print(f"✓ V1图表生成成功：{out_v1}")
-        except Exception as e:
-            print(f"✗ V1代码执行失败：{e}")
-            return {"error": str(e)}
+    if n_candidates > 1:
+        # 1) + 2) best-of-N：并发生成多个候选，执行后用本地检查挑选最佳者作为 V1
+        code_v1, candidates, chart_v1 = _best_of_n_v1(
+            user_instructions, candidate_models or [generation_model], n_candidates,
+            image_basename, out_v1, df, executor, validate, agg, preview_dpi,
+        )
+        if code_v1 is None:
+            return {"error": "All V1 candidates failed", "candidates": candidates}
     else:
-        print("✗ 未找到可执行代码标签")
-        return {"error": "No executable code found"}
-
-    # 3) 对 V1 进行反思
-    print(f"\n🔍 步骤 3：对 V1 进行反思...")
-    print(f"  使用模型：{reflection_model}")
-    feedback, code_v2 = reflect_on_image_and_regenerate(
-        chart_path=out_v1,
-        instruction=user_instructions,
-        model_name=reflection_model,
-        out_path_v2=out_v2,
-        code_v1=code_v1,
-    )
-    print(f"✓ 反思完成")
-    print(f"  反馈：{feedback[:100]}..." if len(feedback) > 100 else f"  反馈：{feedback}")
-
-    # 4) 执行 V2
-    print(f"\n🎨 步骤 4：执行改进后的绘图代码（V2）...")
-    match = re.search(r"<execute_python>([\s\S]*?)</execute_python>", code_v2)
-    if match:
-        reflected_code = match.group(1).strip()
-        exec_globals = {"df": df}
-        try:
-            exec(reflected_code, exec_globals)
-            print(f"✓ V2图表生成成功：{out_v2}")
-        except Exception as e:
-            print(f"✗ V2代码执行失败：{e}")
-            return {
-                "code_v1": code_v1,
-                "chart_v1": out_v1,
-                "feedback": feedback,
-                "error_v2": str(e)
-            }
-    else:
-        print("✗ 未找到可执行代码标签")
+        candidates = None
+
+        # 1) 生成代码 (V1)
+        print(f"\n📝 步骤 1：生成绘图代码（V1）...")
+        print(f"  使用模型：{generation_model}")
+        with tracing.span("generate_v1"):
+            code_v1 = generate_chart_code(
+                instruction=user_instructions,
+                model=generation_model,
+                out_path_v1=out_v1,
+            )
+        print(f"✓ V1代码生成成功（{len(code_v1)} 字符）")
+
+        # 2) 执行 V1
+        print(f"\n💻 步骤 2：执行绘图代码（V1）...")
+        with tracing.span("execute_v1"):
+            code_v1, diagnostics = _validate(code_v1, out_v1, validate)
+            if has_errors(diagnostics):
+                print("✗ V1代码未通过静态检查，不执行")
+                return {"code_v1": code_v1, "error": format_diagnostics(diagnostics), "diagnostics_v1": diagnostics}
+            error, chart_v1 = _render(code_v1, df, out_v1, executor, agg, preview_dpi)
+        if error == NO_CODE_ERROR:
+            print("✗ 未找到可执行代码标签")
+            return {"error": error}
+        elif error:
+            print(f"✗ V1代码执行失败：{error}")
+            return {"error": error}
+        print(f"✓ V1图表生成成功：{_chart_label(chart_v1)}")
+
+    if candidates is not None:
+        diagnostics = next(c["diagnostics"] for c in candidates if c.get("selected"))
+    result = {"code_v1": code_v1, "chart_v1": _on_disk(chart_v1), "diagnostics_v1": diagnostics}
+    if candidates is not None:
+        result["candidates"] = candidates
+
+    # 3) + 4) 反思 → 执行改进代码，最多 max_rounds 轮，收敛后提前结束
+    rounds = []
+    chart_prev, code_prev, out_prev = chart_v1, code_v1, out_v1
+    for r in range(1, max_rounds + 1):
+        label_prev, label_next = f"V{r}", f"V{r + 1}"
+        out_next = f"{image_basename}_v{r + 1}.png"
+        round_note = f"（第 {r}/{max_rounds} 轮）" if max_rounds > 1 else ""
+        # 最后一轮的结果执行成功即为最终版本，直接按全分辨率写盘
+        dpi_next = preview_dpi if r < max_rounds else None
+
+        print(f"\n🔍 步骤 3：对 {label_prev} 进行反思{round_note}...")
+        print(f"  使用模型：{reflection_model}")
+        with tracing.span(f"reflect_v{r}"):
+            feedback, code_next, diagnostics, pending = _reflect_step(
+                chart_path=chart_prev,
+                instruction=user_instructions,
+                model_name=reflection_model,
+                out_path=out_next,
+                code_prev=code_prev,
+                diagnostics=diagnostics,
+                executor=executor,
+                stream=stream,
+                validate=validate,
+                preview_dpi=dpi_next,
+                path_prev=out_prev if r > 1 else None,
+            )
+        if r == 1:
+            result["feedback"] = feedback
+            result["code_v2"] = code_next
+        elif _same_code(code_prev, code_next, out_prev, out_next):
+            print("✓ 反思未提出新的修改，提前结束")
+            break
+
+        print(f"\n🎨 步骤 4：执行改进后的绘图代码（{label_next}）...")
+        with tracing.span(f"execute_v{r + 1}"):
+            if has_errors(diagnostics):
+                error = format_diagnostics(diagnostics)
+            elif pending is not None:
+                error, chart_next = _outcome(executor.result(pending))
+            else:
+                error, chart_next = _render(code_next, df, out_next, executor, agg, dpi_next)
+        if error == NO_CODE_ERROR:
+            print("✗ 未找到可执行代码标签")
+            break
+        elif error:
+            print(f"✗ {label_next}代码执行失败：{error}")
+            if r == 1:
+                return {
+                    "code_v1": code_v1,
+                    "chart_v1": _render_final(code_v1, chart_v1, out_v1, df, executor, agg),
+                    "feedback": feedback,
+                    "error_v2": error
+                }
+            break
+        print(f"✓ {label_next}图表生成成功：{_chart_label(chart_next)}")
+        if r == 1:
+            result["chart_v2"] = _on_disk(chart_next)
+
+        similarity = utils.image_similarity(chart_prev, chart_next)
+        rounds.append({
+            "round": r,
+            "feedback": feedback,
+            "code": code_next,
+            "chart": _on_disk(chart_next),
+            "diagnostics": diagnostics,
+            "similarity": similarity,
+        })
+        chart_prev, code_prev, out_prev = chart_next, code_next, out_next
+        if r < max_rounds and similarity >= converge_threshold:
+            print(f"✓ 与 {label_prev} 的图像相似度 {similarity:.1%}，已收敛")
+            break
+
+    # 预览模式下最终采纳的版本还只在内存中，补一次全分辨率写盘并回填图表字段
+    final_chart = _render_final(code_prev, chart_prev, out_prev, df, executor, agg)
+    if final_chart is not None:
+        if out_prev == out_v1:
+            result["chart_v1"] = final_chart
+        else:
+            rounds[-1]["chart"] = final_chart
+        if out_prev == out_v2:
+            result["chart_v2"] = final_chart
 
     print("\n" + "="*70)
     print("✅ 工作流完成！")
     print("="*70)
+    stats = utils.response_cache.stats()
+    print(f"🗃️  响应缓存：命中 {stats['hits']} 次，未命中 {stats['misses']} 次（命中率 {stats['hit_rate']:.0%}）")
 
-    return {
-        "code_v1": code_v1,
-        "chart_v1": out_v1,
-        "feedback": feedback,
-        "code_v2": code_v2,
-        "chart_v2": out_v2,
-    }
+    result["rounds"] = rounds
+    result["final_code"] = code_prev
+    result["final_chart"] = final_chart
+    if cache_key is not None and final_chart is not None:
+        result_cache.set(cache_key, image_basename, result)
+    return result
+
+
+def _best_of_n_v1(
+    instruction: str,
+    models: list[str],
+    n: int,
+    image_basename: str,
+    out_v1: str,
+    df,
+    executor: ChartExecutor | None,
+    validate: bool = True,
+    agg=None,
+    preview_dpi: int | None = None,
+):
+    """
+    生成并执行 n 个 V1 候选，把得分最高者的图表与代码改名为 V1，其余候选的图表文件随即删除。
+    设置 preview_dpi 时候选只在内存中渲染，选中者的 PNG 字节即为 V1 图表。
+
+    返回:
+        (code_v1, candidates, chart_v1) 元组；全部失败时 code_v1 与 chart_v1 为 None
+    """
+    print(f"\n📝 步骤 1：并发生成 {n} 个 V1 候选...")
+    print(f"  使用模型：{', '.join(models)}")
+    with tracing.span("generate_v1", candidates=n):
+        candidates = generate_chart_candidates(instruction, models, n, image_basename)
+
+    print(f"\n💻 步骤 2：执行并评估候选...")
+    with tracing.span("execute_v1", candidates=n):
+        for c in candidates:
+            if "code" not in c:
+                continue
+            # 静态检查不通过的候选直接淘汰，不占用执行时间
+            c["code"], c["diagnostics"] = _validate(c["code"], c["out_path"], validate)
+            if has_errors(c["diagnostics"]):
+                c["error"] = format_diagnostics(c["diagnostics"])
+        runnable = [c for c in candidates if "code" in c and not c.get("error")]
+        charts = {}
+        if executor is not None:
+            # 全部提交到进程池后再统一等待，候选之间并行渲染
+            futures = [(c, executor.submit(c["code"], c["out_path"], preview_dpi)) for c in runnable]
+            for c, future in futures:
+                c["error"], charts[c["out_path"]] = _outcome(executor.result(future))
+        else:
+            for c in runnable:
+                c["error"], charts[c["out_path"]] = _render(c["code"], df, c["out_path"], executor, agg, preview_dpi)
+
+    best = None
+    for i, c in enumerate(candidates):
+        if c.get("error"):
+            print(f"  ✗ 候选 {i}（{c['model']}）失败：{c['error']}")
+            continue
+        c.update(score_chart_candidate(c["code"], charts[c["out_path"]]))
+        print(f"  ✓ 候选 {i}（{c['model']}）得分 {c['score']}")
+        if best is None or c["score"] > best["score"]:
+            best = c
+    if best is None:
+        print("✗ 所有候选均执行失败")
+        _remove_candidate_charts(candidates)
+        return None, candidates, None
+
+    chart_v1 = charts[best["out_path"]]
+    if isinstance(chart_v1, str):
+        os.replace(best["out_path"], out_v1)
+        chart_v1 = out_v1
+    _remove_candidate_charts(candidates)
+    best["selected"] = True
+    print(f"✓ 选中候选 {candidates.index(best)}，V1图表：{_chart_label(chart_v1)}")
+    return best["code"].replace(best["out_path"], out_v1), candidates, chart_v1
+
+
+def _remove_candidate_charts(candidates: list[dict]) -> None:
+    # 落选（以及执行失败前可能已写出部分内容）的候选图表；选中者已改名为 V1
+    for c in candidates:
+        if c.get("out_path"):
+            try:
+                os.remove(c["out_path"])
+            except FileNotFoundError:
+                pass
+
+
+def _reflect_step(
+    chart_path: str | bytes,
+    instruction: str,
+    model_name: str,
+    out_path: str,
+    code_prev: str,
+    diagnostics: list[dict] | None,
+    executor: ChartExecutor | None,
+    stream: bool,
+    validate: bool = True,
+    preview_dpi: int | None = None,
+    path_prev: str | None = None,
+):
+    """
+    单轮反思（打印进度），返回的代码已经过静态检查与修补。
+    preview_dpi 只影响流式模式下提前提交给 executor 的执行（见 ChartExecutor.submit）。
+    给出 path_prev（上一版的输出路径）时，与上一版相同的代码不会提前提交：
+    调用方会因此提前结束循环，不再等待这次执行，提交了只会留下多余的图表文件。
+
+    返回:
+        (feedback, code, diagnostics, pending) 元组；流式模式下代码已提前提交时
+        pending 为 executor 返回的 Future，否则为 None
+    """
+    pending = None
+    code_diagnostics = None
+    if stream:
+        print("  反馈：", end="", flush=True)
+        for kind, payload in reflect_on_image_and_regenerate_stream(
+            chart_path=chart_path,
+            instruction=instruction,
+            model_name=model_name,
+            out_path_v2=out_path,
+            code_v1=code_prev,
+            diagnostics=diagnostics,
+        ):
+            if kind == "feedback_delta":
+                print(payload, end="", flush=True)
+            elif kind == "code" and executor is not None:
+                # 代码块一闭合就检查并开始执行，不等待流结束
+                patched, code_diagnostics = _validate(payload, out_path, validate)
+                unchanged = path_prev is not None and _same_code(code_prev, patched, path_prev, out_path)
+                if not has_errors(code_diagnostics) and not unchanged:
+                    pending = executor.submit(patched, out_path, preview_dpi)
+            elif kind == "done":
+                feedback, code = payload
+        if code_diagnostics is not None:
+            code = patched
+        print()
+        print(f"✓ 反思完成")
+    else:
+        feedback, code = reflect_on_image_and_regenerate(
+            chart_path=chart_path,
+            instruction=instruction,
+            model_name=model_name,
+            out_path_v2=out_path,
+            code_v1=code_prev,
+            diagnostics=diagnostics,
+        )
+        print(f"✓ 反思完成")
+        print(f"  反馈：{feedback[:100]}..." if len(feedback) > 100 else f"  反馈：{feedback}")
+    if code_diagnostics is None:
+        code, code_diagnostics = _validate(code, out_path, validate)
+    return feedback, code, code_diagnostics, pending
+
+
+def _validate(code_with_tags: str, out_path: str, enabled: bool = True) -> tuple[str, list[dict]]:
+    """执行前静态检查并打印修补项；enabled 为 False 时原样返回。"""
+    if not enabled:
+        return code_with_tags, []
+    code_with_tags, diagnostics = validate_chart_code(code_with_tags, out_path)
+    for d in diagnostics:
+        if d["level"] != "warning":
+            print(f"  {'⚠️ 已修补' if d['level'] == 'fixed' else '✗ 拒绝'}：{d['message']}")
+    return code_with_tags, diagnostics
+
+
+def _same_code(code_prev: str, code_next: str, path_prev: str, path_next: str) -> bool:
+    """忽略空白与输出路径差异后，两版代码是否相同。"""
+    def norm(code: str) -> str:
+        return re.sub(r"\s+", " ", code).strip()
+    return norm(code_prev.replace(path_prev, path_next)) == norm(code_next)
+
+
+# ============================================================================
+# 第4部分：异步批量工作流
+# ============================================================================
+
+# pyplot 依赖进程级全局状态，在当前进程内执行绘图代码时需串行化
+_EXEC_LOCK = threading.Lock()
+
+
+def execute_chart_code(code_with_tags: str, df, agg=None) -> str | None:
+    """
+    在当前进程内从 <execute_python> 标签中提取代码并执行（未使用进程池时的回退路径）。
+
+    参数:
+        code_with_tags: 包含在 <execute_python> 标签中的代码
+        df: 注入执行环境的 DataFrame（按 shared_layout 的布局传入副本，与进程池中的 df 一致，见 exec_copy）
+        agg: 注入为 agg 的预聚合立方体（agg_cube.build_agg_cube），为 None 时由 df 现算
+
+    返回:
+        None 表示执行成功，否则为错误信息字符串
+    """
+    return _exec_in_process(code_with_tags, df, agg)[0]
+
+
+def render_chart_preview(code_with_tags: str, df, agg=None, dpi: int = PREVIEW_DPI) -> tuple[str | None, bytes | None]:
+    """
+    在当前进程内以低 dpi 渲染到内存（不写磁盘），用于只送去反思的中间版本。
+
+    返回:
+        (错误信息, PNG 字节) 元组；成功时错误信息为 None
+    """
+    error, images = _exec_in_process(code_with_tags, df, agg, dpi)
+    if error is None and not images:
+        error = NO_SAVEFIG_ERROR
+    return error, (images[-1] if error is None else None)
+
+
+def _exec_in_process(code_with_tags: str, df, agg=None, preview_dpi: int | None = None) -> tuple[str | None, list[bytes]]:
+    code = extract_code(code_with_tags)
+    if code is None:
+        return NO_CODE_ERROR, []
+    # 写时复制开启时（pandas 3）只做浅拷贝；pandas 2.x 下不能改动调用方进程的全局选项，退回深拷贝
+    exec_globals = {"df": exec_copy(shared_layout(df)), "agg": (build_agg_cube(df) if agg is None else agg).copy()}
+    with _EXEC_LOCK:
+        try:
+            if preview_dpi:
+                # 替换 savefig 的是类属性，必须与其他执行一样持有锁
+                with capture_savefig(preview_dpi) as images:
+                    exec(code, exec_globals)
+                return None, images
+            exec(code, exec_globals)
+        except Exception as e:
+            return str(e), []
+    return None, []
+
+
+def _render(
+    code_with_tags: str,
+    df,
+    out_path: str,
+    executor: ChartExecutor | None,
+    agg=None,
+    preview_dpi: int | None = None,
+) -> tuple[str | None, str | bytes | None]:
+    """
+    有进程池时交给工作进程执行，否则在当前进程内执行。
+
+    返回:
+        (错误信息, 图表) 元组；图表为写入的 out_path，预览模式下为内存中的 PNG 字节
+    """
+    if executor is not None:
+        return _outcome(executor.run(code_with_tags, out_path, preview_dpi))
+    if preview_dpi:
+        return render_chart_preview(code_with_tags, df, agg, preview_dpi)
+    error = execute_chart_code(code_with_tags, df, agg)
+    return error, (None if error else out_path)
+
+
+def _outcome(run_result: dict) -> tuple[str | None, str | bytes | None]:
+    """把 ChartExecutor 的结果字典转成 _render 的 (错误信息, 图表) 形式。"""
+    return run_result["error"], run_result.get("image") or run_result["path"]
+
+
+def _render_final(code_with_tags: str, chart, out_path: str, df, executor: ChartExecutor | None, agg=None) -> str | None:
+    """最终版本只有预览（PNG 字节）时按全分辨率写入 out_path；已在磁盘上则直接返回。失败时返回 None。"""
+    if isinstance(chart, str):
+        return chart
+    print(f"\n🖨️  以全分辨率渲染最终版本：{out_path}")
+    with tracing.span("render_final"):
+        error, chart = _render(code_with_tags, df, out_path, executor, agg)
+    if error:
+        print(f"✗ 最终版本渲染失败：{error}")
+        return None
+    return chart
+
+
+def _on_disk(chart) -> str | None:
+    return chart if isinstance(chart, str) else None
+
+
+def _chart_label(chart) -> str:
+    return chart if isinstance(chart, str) else f"内存预览（{len(chart) // 1024} KB，未写盘）"
+
+
+async def agenerate_chart_code(instruction: str, model: str, out_path_v1: str) -> str:
+    """generate_chart_code 的异步版本。"""
+    prompt = build_generation_prompt(instruction, out_path_v1)
+    return await utils.aget_response(model, prompt)
+
+
+async def areflect_on_image_and_regenerate(
+    chart_path: str | bytes,
+    instruction: str,
+    model_name: str,
+    out_path_v2: str,
+    code_v1: str,
+    diagnostics: list[dict] | None = None,
+) -> tuple[str, str]:
+    """reflect_on_image_and_regenerate 的异步版本。"""
+    media_type, image_bytes, b64 = utils.prepare_image(chart_path)
+    prompt = build_reflection_prompt(instruction, code_v1, out_path_v2, diagnostics)
+
+    provider = utils.provider_for(model_name)
+    if provider == "fake":
+        content = await utils.aimage_fake_call(model_name, prompt, media_type, b64)
+    elif provider == "anthropic":
+        content = await utils.aimage_anthropic_call(model_name, prompt, media_type, b64)
+    elif provider == "gemini":
+        content = await utils.aimage_gemini_call(model_name, prompt, media_type, b64, image_bytes)
+    else:
+        content = await utils.aimage_openai_call(model_name, prompt, media_type, b64)
+
+    return parse_reflection(content)
+
+
+async def _arun_one(
+    df,
+    user_instructions: str,
+    generation_model: str,
+    reflection_model: str,
+    image_basename: str,
+    limits: dict,
+    executor: ChartExecutor,
+    preview_dpi: int | None = None,
+) -> dict:
+    """单条指令的异步流水线；LLM 调用只在各自供应商的信号量内进行。"""
+    out_v1 = f"{image_basename}_v1.png"
+    out_v2 = f"{image_basename}_v2.png"
+    result = {"instruction": user_instructions}
+
+    with tracing.span("generate_v1"):
+        async with limits[utils.provider_for(generation_model)]:
+            code_v1 = await agenerate_chart_code(user_instructions, generation_model, out_v1)
+    code_v1, diagnostics = validate_chart_code(code_v1, out_v1)
+    result["code_v1"] = code_v1
+    if has_errors(diagnostics):
+        result["error"] = format_diagnostics(diagnostics)
+        return result
+
+    with tracing.span("execute_v1"):
+        error, chart_v1 = _outcome(await executor.arun(code_v1, out_v1, preview_dpi))
+    if error:
+        result["error"] = error
+        return result
+    result["chart_v1"] = _on_disk(chart_v1)
+
+    async def keep_v1() -> dict:
+        # V2 失败时 V1 即为最终版本，预览模式下补一次全分辨率写盘
+        if result["chart_v1"] is None:
+            with tracing.span("render_final"):
+                error, result["chart_v1"] = _outcome(await executor.arun(code_v1, out_v1))
+            if error:
+                result["error"] = error
+        return result
+
+    try:
+        with tracing.span("reflect_v1"):
+            async with limits[utils.provider_for(reflection_model)]:
+                feedback, code_v2 = await areflect_on_image_and_regenerate(
+                    chart_path=chart_v1,
+                    instruction=user_instructions,
+                    model_name=reflection_model,
+                    out_path_v2=out_v2,
+                    code_v1=code_v1,
+                    diagnostics=diagnostics,
+                )
+    except Exception as e:
+        # 反思调用失败（重试耗尽、回复无法解析等）同样视为 V2 失败，保留已生成的 V1
+        result["error_v2"] = str(e)
+        return await keep_v1()
+    code_v2, diagnostics = validate_chart_code(code_v2, out_v2)
+    result["feedback"] = feedback
+    result["code_v2"] = code_v2
+    if has_errors(diagnostics):
+        result["error_v2"] = format_diagnostics(diagnostics)
+        return await keep_v1()
+
+    with tracing.span("execute_v2"):
+        error = (await executor.arun(code_v2, out_v2))["error"]
+    if error:
+        result["error_v2"] = error
+        return await keep_v1()
+    result["chart_v2"] = out_v2
+    return result
+
+
+async def arun_workflows(
+    instructions: list[str],
+    dataset_path: str,
+    generation_model: str,
+    reflection_model: str,
+    image_basename: str = "chart",
+    concurrency: int = 4,
+    timeout: float | None = None,
+    executor: ChartExecutor | None = None,
+    preview: bool = False,
+) -> list[dict]:
+    """
+    并发运行多条指令的反思工作流。
+
+    每个供应商（anthropic / gemini / openai）各有一个容量为 concurrency 的信号量，
+    单条指令的慢调用只占用自己的名额，不会阻塞其他指令。
+
+    参数:
+        instructions: 用户指令列表
+        dataset_path: CSV数据文件路径（整批只加载一次）
+        generation_model: 用于生成V1代码的模型
+        reflection_model: 用于反思和生成V2的模型
+        image_basename: 图表文件的基础名称，第 i 条指令输出为 {image_basename}_{i}_v1/v2.png
+        concurrency: 每个供应商的最大并发请求数
+        timeout: 单条指令的超时秒数，None 表示不限制
+        executor: 可选的 ChartExecutor；为 None 时为本批次创建一个进程池，结束后关闭
+        preview: 为 True 时 V1 只以低 dpi 渲染到内存送去反思，只有 V2（或 V2 失败时的 V1）写入磁盘
+
+    返回:
+        与 instructions 顺序一致的结果字典列表；失败的指令包含 "error" 或 "error_v2"
+    """
+    df = utils.load_and_prepare_data(dataset_path)
+    limits = {p: asyncio.BoundedSemaphore(concurrency) for p in ("anthropic", "gemini", "openai", "fake")}
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ChartExecutor(df, agg=utils.load_agg_cube(dataset_path, df))
+        await asyncio.to_thread(executor.warm_up)
+
+    async def guarded(i: int, instruction: str) -> dict:
+        # 每条指令一个独立的 trace
+        with tracing.span("arun_one", index=i) as root:
+            try:
+                result = await asyncio.wait_for(
+                    _arun_one(df, instruction, generation_model, reflection_model,
+                              f"{image_basename}_{i}", limits, executor,
+                              PREVIEW_DPI if preview else None),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                result = {"instruction": instruction, "error": f"Timed out after {timeout}s"}
+            except Exception as e:
+                result = {"instruction": instruction, "error": str(e)}
+        result["trace_id"] = root.trace_id
+        return result
+
+    try:
+        results = await asyncio.gather(*(guarded(i, ins) for i, ins in enumerate(instructions)))
+    finally:
+        if owns_executor:
+            executor.shutdown()
+    ok = sum(1 for r in results if "chart_v2" in r)
+    print(f"✅ 批量工作流完成：{ok}/{len(results)} 条指令生成了 V2 图表")
+    return list(results)
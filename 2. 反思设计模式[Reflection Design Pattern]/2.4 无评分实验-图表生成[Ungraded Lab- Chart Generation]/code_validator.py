@@ -0,0 +1,217 @@
+"""
+生成代码的静态校验 - 执行前基于 AST 拦截或自动修补常见违规写法
+  - 重新定义 df / 从文件读取数据          → 删除该语句（df 已注入）；
+                                            元组/星号解包中的 df 改绑到 _
+  - 用字面量构造 pd.DataFrame(...) 假数据 → 拒绝执行（只给列名的空表仅警告）
+  - 调用 plt.show()                       → 删除
+  - savefig 路径与要求不符 / 缺少 savefig → 改写为指定路径 / 补在首个 plt.close()、
+                                            plt.show() 之前（没有则补在末尾）
+诊断结果为结构化字典列表，可直接拼进反思提示词
+"""
+
+import ast
+
+from chart_executor import extract_code
+
+READ_FUNCS = {"read_csv", "read_excel", "read_json", "read_parquet", "read_table", "read_sql", "read_pickle"}
+
+
+def _diag(level: str, rule: str, node, message: str) -> dict:
+    return {"level": level, "rule": rule, "line": getattr(node, "lineno", None), "message": message}
+
+
+def _call_name(node: ast.Call) -> str:
+    func = node.func
+    return func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", "")
+
+
+def _references_name(node, name: str) -> bool:
+    return any(isinstance(n, ast.Name) and n.id == name for n in ast.walk(node))
+
+
+def _references_any_name(node) -> bool:
+    # 只有常量（以及 pd/np 之类的模块属性）时视为字面量构造
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and n.id not in ("pd", "np", "pandas", "numpy"):
+            return True
+    return False
+
+
+def _is_plt_call(node, names: set) -> bool:
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and node.func.attr in names
+            and isinstance(node.func.value, ast.Name) and node.func.value.id in ("plt", "pyplot"))
+
+
+def _df_targets(stmt) -> list:
+    """赋值语句中绑定 df 的 Name 节点（含元组、列表、星号解包）。"""
+    if isinstance(stmt, ast.Assign):
+        targets = stmt.targets
+    elif isinstance(stmt, ast.AnnAssign):
+        targets = [stmt.target]
+    else:
+        return []
+    return [n for t in targets for n in ast.walk(t)
+            if isinstance(n, ast.Name) and n.id == "df" and isinstance(n.ctx, ast.Store)]
+
+
+class _Patcher(ast.NodeTransformer):
+    def __init__(self, out_path: str):
+        self.out_path = out_path
+        self.diagnostics = []
+        self.changed = False
+        self.savefig_calls = 0
+
+    def _drop(self, stmt, rule: str, message: str):
+        # 返回 None 即从所在语句块中删除该语句
+        self.diagnostics.append(_diag("fixed", rule, stmt, message))
+        self.changed = True
+        return None
+
+    def _visit_assign(self, node):
+        names = _df_targets(node)
+        if names:
+            value = node.value
+            if value is not None and not _references_name(value, "df"):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                if targets == names:
+                    return self._drop(node, "df_reassign",
+                                      "Removed assignment that replaced the provided df; use the existing df.")
+                # 解包或链式赋值里还绑定了其他变量，只把 df 改绑到 _，其余照常赋值
+                for n in names:
+                    n.id = "_"
+                self.diagnostics.append(_diag("fixed", "df_reassign", node,
+                                              "Unpacked value no longer replaces the provided df (bound to _)."))
+                self.changed = True
+            else:
+                self.diagnostics.append(_diag("warning", "df_reassign", node,
+                                              "df is reassigned from itself; prefer a new variable name."))
+        self.generic_visit(node)
+        return node
+
+    visit_Assign = visit_AnnAssign = _visit_assign
+
+    def visit_AugAssign(self, node):
+        # df += ... 读取并修改现有 df，属于使用而非替换
+        if isinstance(node.target, ast.Name) and node.target.id == "df":
+            self.diagnostics.append(_diag("warning", "df_reassign", node,
+                                          "df is modified in place; prefer a new variable name."))
+        self.generic_visit(node)
+        return node
+
+    def visit_Expr(self, node):
+        if isinstance(node.value, ast.Call) and _call_name(node.value) == "show":
+            return self._drop(node, "plt_show", "Removed plt.show(); charts must only be saved to disk.")
+        self.generic_visit(node)
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = _call_name(node)
+        if name == "DataFrame" and not _references_any_name(node):
+            if node.args or any(kw.arg == "data" for kw in node.keywords):
+                self.diagnostics.append(_diag("error", "fake_dataframe", node,
+                                              "pd.DataFrame(...) is built from literals; plot the real df instead."))
+            else:
+                # 只给 columns/index 的空表常用作结果容器，本身不是假数据
+                self.diagnostics.append(_diag("warning", "fake_dataframe", node,
+                                              "Empty pd.DataFrame(...) built from literals; make sure it is filled "
+                                              "from df before plotting."))
+        elif name in READ_FUNCS:
+            self.diagnostics.append(_diag("error", "reads_file", node,
+                                          f"{name}() reads data from disk; df is already loaded."))
+        elif name == "savefig":
+            self.savefig_calls += 1
+            target = node.args[0] if node.args else next(
+                (kw.value for kw in node.keywords if kw.arg == "fname"), None)
+            if not (isinstance(target, ast.Constant) and target.value == self.out_path):
+                self.diagnostics.append(_diag("fixed", "savefig_path", node,
+                                              f"Rewrote savefig target to '{self.out_path}'."))
+                self.changed = True
+                path = ast.Constant(self.out_path)
+                if node.args:
+                    node.args[0] = path
+                else:
+                    node.keywords = [kw for kw in node.keywords if kw.arg != "fname"]
+                    node.args.insert(0, path)
+        return node
+
+
+def _fill_empty_blocks(tree: ast.AST) -> None:
+    # 删除语句后 if/for/with 等块可能为空，补 pass 保证仍可编译
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Module):
+            continue
+        if isinstance(getattr(node, "body", None), list) and not node.body:
+            node.body = [ast.Pass()]
+
+
+def validate_chart_code(code_with_tags: str, out_path: str) -> tuple[str, list[dict]]:
+    """
+    执行前静态校验并修补绘图代码。
+
+    参数:
+        code_with_tags: 包含在 <execute_python> 标签中的代码
+        out_path: 代码必须保存到的图表路径
+
+    返回:
+        (patched_code_with_tags, diagnostics) 元组
+        - patched_code_with_tags: 修补后的代码（无修改时与输入相同）
+        - diagnostics: [{"level": "error"|"fixed"|"warning", "rule", "line", "message"}]；
+          存在 level == "error" 的条目时不应执行该代码
+    """
+    code = extract_code(code_with_tags)
+    if code is None:
+        return code_with_tags, [_diag("error", "no_code", None, "No <execute_python> block found.")]
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return code_with_tags, [{"level": "error", "rule": "syntax", "line": e.lineno, "message": str(e)}]
+
+    # 缺少 savefig 时要在修补前定位插入点：plt.show() 会被删除，
+    # 而补在 plt.close() 之后只会保存一张空白图
+    missing_diag = None
+    if not any(isinstance(n, ast.Call) and _call_name(n) == "savefig" for n in ast.walk(tree)):
+        index = next((i for i, stmt in enumerate(tree.body)
+                      if isinstance(stmt, ast.Expr) and _is_plt_call(stmt.value, {"close", "show"})), None)
+        if index is not None:
+            tree.body[index:index] = ast.parse(
+                f"import matplotlib.pyplot as plt\nplt.savefig({out_path!r}, dpi=300)").body
+            missing_diag = _diag("fixed", "missing_savefig", tree.body[index + 2],
+                                 f"Inserted plt.savefig('{out_path}', dpi=300) before the figure is closed.")
+        elif any(_is_plt_call(n, {"close", "show"}) for n in ast.walk(tree)):
+            # plt.close()/show() 只出现在循环、函数等代码块内，无法确定保存位置
+            return code_with_tags, [_diag("error", "missing_savefig", None,
+                                          "The figure is closed inside a block and never saved; "
+                                          f"call plt.savefig('{out_path}', dpi=300) before plt.close().")]
+        else:
+            tree.body.extend(ast.parse(
+                f"import matplotlib.pyplot as plt\nplt.savefig({out_path!r}, dpi=300)\nplt.close('all')"
+            ).body)
+            missing_diag = _diag("fixed", "missing_savefig", None,
+                                 f"Appended plt.savefig('{out_path}', dpi=300).")
+
+    patcher = _Patcher(out_path)
+    tree = patcher.visit(tree)
+    _fill_empty_blocks(tree)
+
+    if missing_diag is not None:
+        patcher.diagnostics.append(missing_diag)
+        patcher.changed = True
+
+    if patcher.changed:
+        code_with_tags = f"<execute_python>\n{ast.unparse(ast.fix_missing_locations(tree))}\n</execute_python>"
+    return code_with_tags, patcher.diagnostics
+
+
+def has_errors(diagnostics: list[dict]) -> bool:
+    return any(d["level"] == "error" for d in diagnostics)
+
+
+def format_diagnostics(diagnostics: list[dict]) -> str:
+    """把诊断列表渲染成适合放进提示词的多行文本。"""
+    lines = []
+    for d in diagnostics:
+        where = f"第 {d['line']} 行" if d.get("line") else "全局"
+        lines.append(f"- [{d['level']}] {d['rule']}（{where}）：{d['message']}")
+    return "\n".join(lines)
@@ -0,0 +1,164 @@
+"""
+LLM 供应商客户端注册表 - 复用连接池与并发限制
+每个供应商只构建一次同步/异步 SDK 客户端，底层共享一个可配置的 httpx 连接池
+（keep-alive、可选 HTTP/2、连接数上限），并为每个供应商提供独立的并发名额
+"""
+
+import os
+import asyncio
+import threading
+import importlib
+import importlib.util
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+
+PROVIDERS = ("anthropic", "gemini", "openai")
+
+# 连接池参数（可通过环境变量覆盖）
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "90"))
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "600"))
+# HTTP/2 需要 h2 包（pip install "httpx[http2]"），未安装时自动退回 HTTP/1.1
+HTTP2_ENABLED = os.getenv("LLM_HTTP2", "1") != "0" and importlib.util.find_spec("h2") is not None
+
+# 每个供应商同时在途的请求数上限，例如 LLM_MAX_CONCURRENCY_OPENAI=16
+DEFAULT_CONCURRENCY = {
+    p: int(os.getenv(f"LLM_MAX_CONCURRENCY_{p.upper()}", "8")) for p in PROVIDERS
+}
+
+
+def _api_key(provider: str) -> str | None:
+    env = {"anthropic": "ANTHROPIC_API_KEY", "gemini": "GOOGLE_API_KEY", "openai": "OPENAI_API_KEY"}
+    return os.getenv(env[provider])
+
+
+class ClientRegistry:
+    """
+    按供应商懒加载并缓存 SDK 客户端。
+
+    参数:
+        max_connections: 每个供应商连接池的最大连接数
+        max_keepalive: 每个供应商保持空闲的最大连接数
+        keepalive_expiry: 空闲连接保留秒数
+        http2: 是否启用 HTTP/2
+        concurrency: {provider: 最大并发请求数}，缺省使用 DEFAULT_CONCURRENCY
+    """
+
+    def __init__(
+        self,
+        max_connections: int = POOL_MAX_CONNECTIONS,
+        max_keepalive: int = POOL_MAX_KEEPALIVE,
+        keepalive_expiry: float = POOL_KEEPALIVE_EXPIRY,
+        http2: bool = HTTP2_ENABLED,
+        concurrency: dict | None = None,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.concurrency = {**DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._async_clients = {}
+        self._slots = {p: threading.BoundedSemaphore(n) for p, n in self.concurrency.items()}
+        # asyncio 信号量绑定事件循环，按循环分别创建
+        self._aslots = weakref.WeakKeyDictionary()
+
+    # ------------------------------------------------------------------
+    # 客户端
+    # ------------------------------------------------------------------
+
+    def _pool_args(self, http_client_cls=None) -> dict:
+        """连接池参数；http_client_cls 为 SDK 的 httpx 客户端类，用于取得同一个包里的 Limits/Timeout。"""
+        # 不同版本的 SDK 底层可能是 httpx 或其分支 httpx2，参数对象必须来自同一个包
+        package = "httpx"
+        if http_client_cls is not None:
+            base = next(c for c in http_client_cls.__mro__ if c.__module__.startswith("httpx"))
+            package = base.__module__.split(".")[0]
+        http = importlib.import_module(package)
+        return dict(
+            limits=http.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=http.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            http2=self.http2,
+        )
+
+    def client(self, provider: str):
+        """返回该供应商的同步客户端（首次调用时创建）；Gemini 返回同时支持 .aio 的 genai.Client。"""
+        with self._lock:
+            if provider not in self._clients:
+                self._clients[provider] = self._build(provider)
+            return self._clients[provider]
+
+    def async_client(self, provider: str):
+        """返回该供应商的异步客户端；Gemini 使用同一个 genai.Client 的 .aio 接口。"""
+        if provider == "gemini":
+            return self.client("gemini").aio
+        with self._lock:
+            if provider not in self._async_clients:
+                self._async_clients[provider] = self._build_async(provider)
+            return self._async_clients[provider]
+
+    def _build(self, provider: str):
+        # SDK 自带的重试关闭（max_retries=0），统一由 resilience.retrying 处理，重试次数也能进入追踪
+        key = _api_key(provider)
+        if provider == "anthropic":
+            import anthropic
+            http_client = anthropic.DefaultHttpxClient(**self._pool_args(anthropic.DefaultHttpxClient))
+            return anthropic.Anthropic(api_key=key, http_client=http_client, max_retries=0)
+        if provider == "gemini":
+            if not key:
+                raise ValueError("Gemini client not initialized. Please set GOOGLE_API_KEY in .env")
+            from google import genai
+            # genai 自行创建同步/异步 httpx 客户端，这里只传入连接池参数
+            pool = self._pool_args()
+            return genai.Client(
+                api_key=key,
+                http_options=genai.types.HttpOptions(client_args=pool, async_client_args=pool),
+            )
+        import openai
+        http_client = openai.DefaultHttpxClient(**self._pool_args(openai.DefaultHttpxClient))
+        return openai.OpenAI(api_key=key, http_client=http_client, max_retries=0)
+
+    def _build_async(self, provider: str):
+        key = _api_key(provider)
+        if provider == "anthropic":
+            import anthropic
+            http_client = anthropic.DefaultAsyncHttpxClient(**self._pool_args(anthropic.DefaultAsyncHttpxClient))
+            return anthropic.AsyncAnthropic(api_key=key, http_client=http_client, max_retries=0)
+        import openai
+        http_client = openai.DefaultAsyncHttpxClient(**self._pool_args(openai.DefaultAsyncHttpxClient))
+        return openai.AsyncOpenAI(api_key=key, http_client=http_client, max_retries=0)
+
+    # ------------------------------------------------------------------
+    # 并发名额
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def slot(self, provider: str):
+        """占用该供应商的一个同步并发名额，名额用尽时阻塞等待。"""
+        with self._slots[provider]:
+            yield
+
+    @asynccontextmanager
+    async def aslot(self, provider: str):
+        """slot 的异步版本，每个事件循环各有一组信号量。"""
+        loop = asyncio.get_running_loop()
+        slots = self._aslots.get(loop)
+        if slots is None:
+            slots = {p: asyncio.BoundedSemaphore(n) for p, n in self.concurrency.items()}
+            self._aslots[loop] = slots
+        async with slots[provider]:
+            yield
+
+    def close(self) -> None:
+        """关闭全部同步客户端的连接池（异步客户端由其事件循环结束时回收）。"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
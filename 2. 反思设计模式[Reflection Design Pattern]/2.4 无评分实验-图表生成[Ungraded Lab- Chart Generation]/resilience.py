@@ -0,0 +1,230 @@
+"""
+LLM 调用的容错层 - 重试与对冲请求
+  - retrying：对 429 / 5xx / 连接错误做带抖动的指数退避重试，优先遵守服务端的 Retry-After
+  - LatencyTracker + hedged_call / ahedged_call：首个请求超过该模型的 p95 延迟仍未返回时，
+    向备用模型再发一份，先成功者胜出
+"""
+
+import os
+import time
+import random
+import asyncio
+import inspect
+import functools
+import threading
+import contextvars
+import email.utils
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import tracing
+
+# 重试策略（可通过环境变量覆盖）
+RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+# 服务端给出的 Retry-After 会被遵守，但不超过该上限
+RETRY_AFTER_CAP = float(os.getenv("LLM_RETRY_AFTER_CAP", "120"))
+
+# 529 为 Anthropic 的 overloaded
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# 没有状态码的网络层异常（openai / anthropic / httpx 的类名）
+RETRYABLE_ERRORS = {
+    "APIConnectionError", "APITimeoutError", "ConnectError", "ConnectTimeout",
+    "ReadTimeout", "ReadError", "RemoteProtocolError", "TimeoutException",
+}
+
+# 对冲：样本不足时使用的固定阈值（秒），以及计算 p95 所需的最少样本数
+HEDGE_DEFAULT_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "15"))
+HEDGE_MIN_SAMPLES = 20
+
+
+def _status_code(exc: BaseException) -> int | None:
+    for attr in ("status_code", "code", "status"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """429、5xx 与连接/超时类错误可重试；4xx 参数错误等直接抛出。"""
+    status = _status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(exc).__mro__)
+
+
+def retry_after_seconds(exc: BaseException) -> float | None:
+    """读取错误响应中的 retry-after-ms / Retry-After（秒数或 HTTP 日期）。"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None) -> float:
+    """第 attempt 次重试（从 0 开始）前的等待秒数：有 Retry-After 时遵守，否则为全抖动指数退避。"""
+    if retry_after is not None:
+        return min(retry_after, RETRY_AFTER_CAP)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _next_delay(exc: BaseException, attempt: int, max_attempts: int) -> float | None:
+    # 返回 None 表示不再重试
+    if attempt + 1 >= max_attempts or not is_retryable(exc):
+        return None
+    span = tracing.current_span()
+    if span is not None:
+        span.add(retries=1)
+    return backoff_delay(attempt, retry_after_seconds(exc))
+
+
+def retrying(fn=None, *, max_attempts: int | None = None):
+    """
+    为同步函数、协程函数或生成器函数加上重试。
+
+    生成器只在产出第一个分块之前失败时重试，避免重复输出已经产出的内容。
+    """
+    def decorate(fn):
+        def attempts():
+            return max_attempts or RETRY_MAX_ATTEMPTS
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                attempt = 0
+                while True:
+                    try:
+                        return await fn(*args, **kwargs)
+                    except Exception as e:
+                        delay = _next_delay(e, attempt, attempts())
+                        if delay is None:
+                            raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                attempt = 0
+                while True:
+                    started = False
+                    chunks = fn(*args, **kwargs)
+                    try:
+                        for chunk in chunks:
+                            started = True
+                            yield chunk
+                        return
+                    except Exception as e:
+                        delay = None if started else _next_delay(e, attempt, attempts())
+                        if delay is None:
+                            raise
+                    finally:
+                        chunks.close()
+                    time.sleep(delay)
+                    attempt += 1
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    delay = _next_delay(e, attempt, attempts())
+                    if delay is None:
+                        raise
+                time.sleep(delay)
+                attempt += 1
+        return wrapper
+
+    return decorate(fn) if fn is not None else decorate
+
+
+class LatencyTracker:
+    """按键（通常是模型名）保存最近 window 次成功调用的耗时，用于估计 p95。"""
+
+    def __init__(self, window: int = 200):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[key].append(seconds)
+
+    def percentile(self, key: str, q: float = 0.95) -> float | None:
+        """样本少于 HEDGE_MIN_SAMPLES 时返回 None。"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_after(self, key: str) -> float:
+        """对冲阈值：有足够样本时为 p95，否则为 HEDGE_DEFAULT_AFTER。"""
+        p95 = self.percentile(key)
+        return p95 if p95 is not None else HEDGE_DEFAULT_AFTER
+
+
+# 同步对冲在线程中发出请求；落败的请求无法中断，会在后台跑完后被丢弃
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+
+
+def hedged_call(primary, backup, after: float):
+    """
+    先调用 primary()；after 秒后仍未返回则同时调用 backup()，返回先成功者的结果。
+
+    返回:
+        (result, used_backup) 元组；两者都失败时抛出 primary 的异常
+    """
+    legs = {_hedge_pool.submit(contextvars.copy_context().run, primary): False}
+    done, _ = wait(legs, timeout=after)
+    if not done:
+        legs[_hedge_pool.submit(contextvars.copy_context().run, backup)] = True
+
+    pending, errors = set(legs), {}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result(), legs[future]
+            errors[legs[future]] = future.exception()
+    raise errors.get(False) or errors[True]
+
+
+async def ahedged_call(primary, backup, after: float):
+    """hedged_call 的异步版本，primary / backup 为无参协程函数；落败的请求会被取消。"""
+    legs = {asyncio.ensure_future(primary()): False}
+    done, _ = await asyncio.wait(legs, timeout=after)
+    if not done:
+        legs[asyncio.ensure_future(backup())] = True
+
+    pending, errors = set(legs), {}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), legs[task]
+                errors[legs[task]] = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise errors.get(False) or errors[True]
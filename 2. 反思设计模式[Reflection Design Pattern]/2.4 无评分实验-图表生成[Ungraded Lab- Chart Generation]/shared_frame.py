@@ -0,0 +1,193 @@
+"""
+共享内存 DataFrame - 基于 NumPy memmap 的列式零拷贝交接
+父进程把准备好的 DataFrame 按列写入 /dev/shm（或临时目录），
+工作进程以只读 memmap 方式挂载，多个进程共享同一份物理内存页
+"""
+
+import os
+import json
+import shutil
+import weakref
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Linux 上 /dev/shm 是内存文件系统，写入的数据不落盘
+DEFAULT_BASE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+MANIFEST_NAME = "manifest.json"
+
+
+def copy_on_write_enabled() -> bool:
+    """pandas 3 起写时复制始终开启；pandas 2.x 默认关闭，需显式设置 mode.copy_on_write。"""
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return True
+    return pd.get_option("mode.copy_on_write") is True
+
+
+def exec_copy(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    交给生成代码的 df 副本。写时复制开启时浅拷贝即可：新增/覆盖列与 df.loc[...] = ...
+    之类的原地写入都不会影响原数据；未开启时（pandas 2.x 默认）浅拷贝与原数据共享内存，只能深拷贝。
+    """
+    return df.copy(deep=not copy_on_write_enabled())
+
+
+# 按共享布局构建的帧带有该标记，再次转换时直接复用
+LAYOUT_ATTR = "shared_layout"
+
+
+def _column_layout(series: pd.Series) -> tuple[dict, np.ndarray]:
+    """把一列转换为共享布局：(描述该列的 manifest 条目, 底层 NumPy 数组)。"""
+    dtype = series.dtype
+    entry = {"name": series.name}
+
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        values = series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy()
+        entry.update(kind="datetime", dtype=values.dtype.str, tz=str(dtype.tz))
+        return entry, values.view("int64")
+    if isinstance(dtype, np.dtype) and dtype.kind == "M":
+        values = series.to_numpy()
+        entry.update(kind="datetime", dtype=values.dtype.str, tz=None)
+        return entry, values.view("int64")
+    if isinstance(dtype, np.dtype) and dtype.kind in "biuf":
+        entry.update(kind="numeric")
+        return entry, series.to_numpy()
+    if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+        # 可空整数/浮点扩展类型：缺失值转为 NaN 以便落成普通 float 数组
+        entry.update(kind="numeric")
+        return entry, series.to_numpy(dtype="float64", na_value=np.nan)
+    # 字符串/对象/已有的分类列统一存为 分类编码 + 类别表
+    cat = series.astype("category").array
+    entry.update(kind="category", categories=cat.categories.tolist(), ordered=bool(cat.ordered))
+    return entry, cat.codes
+
+
+def _column_values(entry: dict, raw: np.ndarray):
+    """_column_layout 的逆过程：由条目与底层数组（可以是 memmap）零拷贝重建列。"""
+    if entry["kind"] == "datetime":
+        values = pd.Series(raw.view(np.dtype(entry["dtype"])), copy=False)
+        if entry["tz"]:
+            values = values.dt.tz_localize("UTC").dt.tz_convert(entry["tz"])
+        return values
+    if entry["kind"] == "category":
+        dtype = pd.CategoricalDtype(entry["categories"], ordered=entry["ordered"])
+        return pd.Categorical.from_codes(raw, dtype=dtype, validate=False)
+    return raw
+
+
+def _build_frame(data: dict) -> pd.DataFrame:
+    df = pd.DataFrame(data, copy=False)
+    df.attrs[LAYOUT_ATTR] = True
+    return df
+
+
+def shared_layout(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    在当前进程内按与 attach_frame 相同的布局重建 DataFrame（不写文件）：
+    字符串/对象列变为分类列，可空数值列变为 float，索引为 RangeIndex。
+    不经过共享内存执行生成代码时使用，使各执行路径下的 df 列类型一致；
+    已是该布局的帧原样返回。
+
+    转换结果按源帧缓存（源帧被回收时释放），对同一个 df 反复执行生成代码
+    （execute_chart_code、基准脚本）只转换一次；源帧的行数或列名变化时重新转换，
+    原地改写源帧中的值则不会被察觉。
+    """
+    if df.attrs.get(LAYOUT_ATTR):
+        return df
+    key = id(df)
+    with _layout_lock:
+        hit = _layout_cache.get(key)
+    if hit is not None and hit[0]() is df and hit[1] == (len(df), tuple(df.columns)):
+        return hit[2]
+
+    data = {}
+    for c in df.columns:
+        entry, raw = _column_layout(df[c])
+        data[c] = _column_values(entry, raw)
+    converted = _build_frame(data)
+    ref = weakref.ref(df, lambda _, key=key: _forget_layout(key))
+    with _layout_lock:
+        _layout_cache[key] = (ref, (len(df), tuple(df.columns)), converted)
+    return converted
+
+
+# id(源帧) -> (源帧的弱引用, (行数, 列名), 转换结果)
+_layout_cache: dict[int, tuple] = {}
+_layout_lock = threading.Lock()
+
+
+def _forget_layout(key: int) -> None:
+    with _layout_lock:
+        _layout_cache.pop(key, None)
+
+
+def export_frame(df: pd.DataFrame, directory: str) -> str:
+    """
+    将 DataFrame 按列写成 .npy 文件，并生成描述各列的 manifest.json。
+
+    参数:
+        df: 待共享的 DataFrame（索引不保留，挂载后为 RangeIndex）
+        directory: 输出目录
+
+    返回:
+        manifest.json 的路径
+    """
+    os.makedirs(directory, exist_ok=True)
+    columns = []
+    for i, c in enumerate(df.columns):
+        entry, raw = _column_layout(df[c])
+        entry["file"] = f"col_{i}.npy"
+        np.save(os.path.join(directory, entry["file"]), raw)
+        columns.append(entry)
+    manifest = {"rows": len(df), "columns": columns}
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, default=str)
+    return path
+
+
+def attach_frame(manifest_path: str) -> pd.DataFrame:
+    """
+    以只读 memmap 挂载 export_frame 写出的列，返回零拷贝的 DataFrame。
+
+    数值/日期列直接引用映射内存，字符串列以分类编码引用映射内存；
+    对列的原地写入会因只读映射而报错，新增或替换列不受影响。
+    """
+    directory = os.path.dirname(manifest_path)
+    with open(manifest_path, encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    data = {}
+    for col in manifest["columns"]:
+        raw = np.load(os.path.join(directory, col["file"]), mmap_mode="r")
+        data[col["name"]] = _column_values(col, raw)
+    return _build_frame(data)
+
+
+class SharedFrame:
+    """
+    持有一份导出的共享 DataFrame，负责在结束时清理文件。
+
+    参数:
+        df: 待共享的 DataFrame
+        base_dir: 存放目录的父目录，默认 /dev/shm（不可用时为系统临时目录）
+    """
+
+    def __init__(self, df: pd.DataFrame, base_dir: str = DEFAULT_BASE_DIR):
+        self.directory = tempfile.mkdtemp(prefix="chart_df_", dir=base_dir)
+        self.manifest_path = export_frame(df, self.directory)
+
+    def attach(self) -> pd.DataFrame:
+        return attach_frame(self.manifest_path)
+
+    def close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,79 +1,513 @@
 # === Standard Library ===
+import io
 import os
+import glob
 import re
 import json
+import time
+import asyncio
 import base64
+import hashlib
+import importlib.util
 import mimetypes
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 # === Third-Party ===
+# Provider SDKs (google-genai, openai, anthropic), PIL, matplotlib and IPython
+# are imported inside the functions that need them: a CLI run that only talks
+# to one provider, or only loads data, never pays for the others.
 import pandas as pd
-import matplotlib.pyplot as plt
-from PIL import Image  # (kept if you need it elsewhere)
 from dotenv import load_dotenv
-from openai import OpenAI
-from anthropic import Anthropic
-from google import genai
 from html import escape
 
+# === Local ===
+from response_cache import ResponseCache, make_cache_key
+from provider_clients import ClientRegistry
+from agg_cube import build_agg_cube, merge_agg_cubes
+import tracing
+import resilience
+import fake_llm
+
+# Old module attributes, still reachable as utils.genai / utils.plt / ... on demand
+_LAZY_ATTRS = {
+    "genai": ("google.genai", None),
+    "plt": ("matplotlib.pyplot", None),
+    "Image": ("PIL.Image", None),
+    "HTML": ("IPython.display", "HTML"),
+    "display": ("IPython.display", "display"),
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    module_name, attr = _LAZY_ATTRS[name]
+    module = importlib.import_module(module_name)
+    value = getattr(module, attr) if attr else module
+    globals()[name] = value
+    return value
+
+
 # === Env & Clients ===
 load_dotenv()
-openai_api_key = os.getenv("OPENAI_API_KEY")
-anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-google_api_key = os.getenv("GOOGLE_API_KEY")
 
-# Both clients read keys from env by default; explicit is also fine:
-openai_client = OpenAI(api_key=openai_api_key) if openai_api_key else OpenAI()
-anthropic_client = Anthropic(api_key=anthropic_api_key) if anthropic_api_key else Anthropic()
+# One pooled client per provider, built on first use and shared by every call
+# below (sync, streaming and async); also caps in-flight requests per provider.
+# Pool size / keep-alive / HTTP/2 are configured via LLM_POOL_* env vars.
+clients = ClientRegistry()
 
-# Configure Gemini using new SDK
-gemini_client = genai.Client(api_key=google_api_key) if google_api_key else None
 
+# === Response Cache ===
+# Set LLM_CACHE=0 to always hit the provider (e.g. when sampling fresh candidates)
+CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+response_cache = ResponseCache()
 
-def get_response(model: str, prompt: str) -> str:
-    if "claude" in model.lower() or "anthropic" in model.lower():
-        # Anthropic Claude format
-        message = anthropic_client.messages.create(
-            model=model,
-            max_tokens=1000,
-            messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+# Temperatures each provider is called with when the caller does not pass one
+# (None means "let the provider use its own default")
+DEFAULT_TEMPERATURES = {"anthropic": None, "gemini": 0.7, "openai": None, "fake": None}
+
+# Optional hedged requests as "primary=backup" pairs, e.g.
+# LLM_HEDGE="gpt-4o=claude-3-5-sonnet-latest,gemini-2.5-pro=gpt-4o".
+# When the primary runs past its p95 latency the backup gets the same prompt
+# and whichever answers first wins.
+HEDGE_MODELS = dict(
+    pair.strip().split("=", 1) for pair in os.getenv("LLM_HEDGE", "").split(",") if "=" in pair
+)
+latency = resilience.LatencyTracker()
+
+
+def provider_for(model: str) -> str:
+    """Map a model name to the provider that serves it."""
+    lower = model.lower()
+    # Offline backend for benchmarks: fake:replay / fake:scripted (see fake_llm.py)
+    if fake_llm.is_fake(lower):
+        return "fake"
+    if "claude" in lower or "anthropic" in lower:
+        return "anthropic"
+    if "gemini" in lower:
+        return "gemini"
+    # Default to OpenAI for all other models (gpt-4, o3-mini, o1, etc.)
+    return "openai"
+
+
+def _text_request(model: str, temperature: float | None) -> tuple[str, float | None]:
+    """Resolve (provider, temperature) for a text call; None means the provider default."""
+    provider = provider_for(model)
+    return provider, DEFAULT_TEMPERATURES[provider] if temperature is None else temperature
+
+
+def _text_cache_key(model: str, prompt: str, temperature: float | None) -> str:
+    provider, temperature = _text_request(model, temperature)
+    return make_cache_key("text", provider, model, prompt, temperature)
+
+
+@tracing.llm_call("text", provider_for)
+@fake_llm.recorded("text")
+def get_response(
+    model: str,
+    prompt: str,
+    temperature: float | None = None,
+    use_cache: bool = True,
+    hedge_model: str | None = None,
+) -> str:
+    """
+    Return the model's text reply, served from the on-disk cache when the same
+    (provider, model, prompt, temperature) was answered before.
+
+    Transient failures (429 / 5xx / connection errors) are retried with backoff.
+    With a hedge model (hedge_model or LLM_HEDGE) a slow call is duplicated to it;
+    an answer from the hedge model is cached under the hedge model's key.
+    """
+    use_cache = use_cache and CACHE_ENABLED
+    if use_cache:
+        cached = response_cache.get(_text_cache_key(model, prompt, temperature))
+        if cached is not None:
+            tracing.annotate(cached=True)
+            return cached
+
+    hedge_model = hedge_model or HEDGE_MODELS.get(model)
+    answered_by = model
+    if hedge_model:
+        text, used_backup = resilience.hedged_call(
+            lambda: _timed_call(model, prompt, temperature),
+            lambda: _timed_call(hedge_model, prompt, temperature),
+            after=latency.hedge_after(model),
         )
+        if used_backup:
+            answered_by = hedge_model
+            tracing.annotate(hedged_by=hedge_model)
+    else:
+        text = _timed_call(model, prompt, temperature)
+
+    if use_cache:
+        response_cache.set(_text_cache_key(answered_by, prompt, temperature), text)
+    return text
+
+
+def _timed_call(model: str, prompt: str, temperature: float | None) -> str:
+    # Only successful calls feed the latency percentiles used for hedging
+    provider, temperature = _text_request(model, temperature)
+    start = time.perf_counter()
+    text = _call_provider(provider, model, prompt, temperature)
+    latency.record(model, time.perf_counter() - start)
+    return text
+
+
+@resilience.retrying
+def _call_provider(provider: str, model: str, prompt: str, temperature: float | None) -> str:
+    if provider == "fake":
+        return fake_llm.complete(model, prompt)
+
+    elif provider == "anthropic":
+        # Anthropic Claude format
+        extra = {"temperature": temperature} if temperature is not None else {}
+        with clients.slot(provider):
+            message = clients.client(provider).messages.create(
+                model=model,
+                max_tokens=1000,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                **extra,
+            )
+        tracing.record_usage(message)
         return message.content[0].text
 
-    elif "gemini" in model.lower():
+    elif provider == "gemini":
         # Google Gemini format (new SDK)
-        if not gemini_client:
-            raise ValueError("Gemini client not initialized. Please set GOOGLE_API_KEY in .env")
-
-        response = gemini_client.models.generate_content(
-            model=model,
-            contents=[prompt],
-            config=genai.types.GenerateContentConfig(
-                temperature=0.7
+        with clients.slot(provider):
+            response = clients.client(provider).models.generate_content(
+                model=model,
+                contents=[prompt],
+                config=_gemini_config(
+                    temperature=temperature
+                )
             )
-        )
+        tracing.record_usage(response)
         return response.text
 
     else:
-        # Default to OpenAI format for all other models (gpt-4, o3-mini, o1, etc.)
-        response = openai_client.responses.create(
-            model=model,
-            input=prompt,
-        )
+        # OpenAI Responses API
+        extra = {"temperature": temperature} if temperature is not None else {}
+        with clients.slot(provider):
+            response = clients.client(provider).responses.create(
+                model=model,
+                input=prompt,
+                **extra,
+            )
+        tracing.record_usage(response)
         return response.output_text
-    
+
 # === Data Loading ===
-def load_and_prepare_data(csv_path: str) -> pd.DataFrame:
-    """Load CSV and derive date parts commonly used in charts."""
-    df = pd.read_csv(csv_path)
+# Low-cardinality text columns stored as pandas categoricals
+CATEGORICAL_COLUMNS = ("coffee_name", "cash_type", "card")
+# Categorical columns are read as strings even when a chunk has no values for
+# them (e.g. only cash rows, empty 'card'), so every segment's categories
+# share one dtype and can be merged
+_CATEGORICAL_DTYPES = {col: str for col in CATEGORICAL_COLUMNS}
+
+# Bump when the prepared layout changes so stale sidecars are rebuilt
+SIDECAR_VERSION = 3
+# Parquet needs pyarrow; without it the sidecar falls back to pandas' pickle format
+SIDECAR_FORMAT = "parquet" if importlib.util.find_spec("pyarrow") else "pickle"
+# Rows appended to the CSV are stored as extra sidecar segments; past this many
+# segments they are compacted back into a single file
+SIDECAR_MAX_SEGMENTS = 8
+# Bytes hashed at the start of the CSV and just before the cached offset to
+# confirm the file was only appended to since the sidecar was written
+APPEND_CHECK_BYTES = 1 << 16
+
+
+def load_and_prepare_data(csv_path: str, use_cache: bool = True) -> pd.DataFrame:
+    """
+    Load CSV and derive date parts commonly used in charts.
+
+    The prepared frame is cached in a typed sidecar next to the CSV
+    (<csv>.parquet + <csv>.meta.json) and reused while the source is unchanged.
+    When the CSV has only grown by appended rows, just the new tail is parsed:
+    it is stored as an extra sidecar segment and folded into the agg cube
+    sidecar, so only the groups it touches change.
+    """
+    if not use_cache:
+        return _parse_csv(csv_path)
+
+    meta = _read_meta(csv_path)
+    state = _sidecar_state(csv_path, meta) if meta is not None else "stale"
+    if state == "fresh":
+        df = _read_segments(csv_path, meta)
+        if df is not None:
+            return df
+    elif state == "appended":
+        df = _append_tail(csv_path, meta)
+        if df is not None:
+            return df
+
+    df = _parse_csv(csv_path)
+    _write_sidecar(csv_path, df)
+    return df
+
+
+def load_agg_cube(csv_path: str, df: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Return the agg cube (agg_cube.build_agg_cube) for a CSV, read from its
+    sidecar when fresh; otherwise built from df (or the loaded CSV).
+    """
+    meta = _read_meta(csv_path)
+    if meta is not None and _sidecar_state(csv_path, meta) == "fresh":
+        cube = _read_frame(_sidecar_file(csv_path, "agg"))
+        if cube is not None:
+            return cube
+    return build_agg_cube(df if df is not None else load_and_prepare_data(csv_path))
+
+
+def dataset_fingerprint(csv_path: str) -> str:
+    """
+    SHA-256 of the CSV contents, identifying a dataset version; taken from the
+    sidecar metadata when it is fresh, so a loaded dataset costs no extra hashing.
+    """
+    meta = _read_meta(csv_path)
+    if meta is not None and _sidecar_state(csv_path, meta) == "fresh":
+        return meta["sha256"]
+    return _file_sha256(csv_path)
+
+
+def _parse_csv(csv_path: str) -> pd.DataFrame:
+    return _derive_columns(pd.read_csv(csv_path, dtype=_CATEGORICAL_DTYPES))
+
+
+def _derive_columns(df: pd.DataFrame) -> pd.DataFrame:
     # Be tolerant if 'date' exists
     if "date" in df.columns:
         df["date"] = pd.to_datetime(df["date"], errors="coerce")
         df["quarter"] = df["date"].dt.quarter
         df["month"] = df["date"].dt.month
         df["year"] = df["date"].dt.year
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _concat_frames(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate sidecar segments, merging categoricals without re-hashing every value."""
+    if len(frames) == 1:
+        return frames[0]
+    from pandas.api.types import union_categoricals
+
+    merged = {
+        col: union_categoricals(_same_category_dtype([f[col] for f in frames]))
+        for col in CATEGORICAL_COLUMNS
+        if all(col in f.columns and isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames)
+    }
+    df = pd.concat(frames, ignore_index=True)
+    for col, values in merged.items():
+        df[col] = values
     return df
 
+
+def _same_category_dtype(columns: list[pd.Series]) -> list[pd.Series]:
+    # union_categoricals requires identical category dtypes; an all-missing
+    # segment may still carry float categories, so fall back to strings
+    if len({c.cat.categories.dtype for c in columns}) <= 1:
+        return columns
+    return [c.cat.rename_categories(c.cat.categories.astype(str)) for c in columns]
+
+
+def _sidecar_file(csv_path: str, part: str) -> Path:
+    """Sidecar data file: part is "" for the base segment, "segN" or "agg"."""
+    ext = ".parquet" if SIDECAR_FORMAT == "parquet" else ".pkl"
+    return Path(f"{csv_path}.{part}{ext}" if part else f"{csv_path}{ext}")
+
+
+def _meta_path(csv_path: str) -> Path:
+    return Path(f"{csv_path}.meta.json")
+
+
+def _file_sha256(path: str, limit: int | None = None) -> str:
+    """SHA-256 of the file, or of its first `limit` bytes."""
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _boundary_hashes(path: str, offset: int) -> tuple[str, str]:
+    """Hashes of the first APPEND_CHECK_BYTES and of the APPEND_CHECK_BYTES before offset."""
+    with open(path, "rb") as f:
+        head = f.read(min(APPEND_CHECK_BYTES, offset))
+        f.seek(max(0, offset - APPEND_CHECK_BYTES))
+        tail = f.read(min(APPEND_CHECK_BYTES, offset))
+    return hashlib.sha256(head).hexdigest(), hashlib.sha256(tail).hexdigest()
+
+
+def _read_meta(csv_path: str) -> dict | None:
+    try:
+        meta = json.loads(_meta_path(csv_path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != SIDECAR_VERSION or meta.get("format") != SIDECAR_FORMAT:
+        return None
+    return meta
+
+
+def _sidecar_state(csv_path: str, meta: dict) -> str:
+    """
+    "fresh" when the CSV is unchanged, "appended" when rows were only added
+    after the cached offset, "stale" otherwise (full reparse).
+    """
+    try:
+        st = os.stat(csv_path)
+    except OSError:
+        return "stale"
+
+    if st.st_size == meta["size"]:
+        if meta["mtime_ns"] == st.st_mtime_ns:
+            return "fresh"
+        # Touched but maybe not modified: fall back to comparing content hashes
+        if meta["sha256"] != _file_sha256(csv_path):
+            return "stale"
+        meta["mtime_ns"] = st.st_mtime_ns
+        _write_json_atomic(_meta_path(csv_path), meta)
+        return "fresh"
+
+    # Growth only counts as an append if the cached part ended on a full line
+    # and its first and last bytes are still the same
+    if st.st_size > meta["size"] and meta["ends_with_newline"]:
+        if _boundary_hashes(csv_path, meta["size"]) == (meta["head_sha256"], meta["tail_sha256"]):
+            return "appended"
+    return "stale"
+
+
+def _read_frame(path: Path) -> pd.DataFrame | None:
+    try:
+        if SIDECAR_FORMAT == "parquet":
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+    except Exception:
+        return None
+
+
+def _write_frame(df: pd.DataFrame, path: Path) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        if SIDECAR_FORMAT == "parquet":
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _read_segments(csv_path: str, meta: dict) -> pd.DataFrame | None:
+    frames = [_read_frame(_sidecar_file(csv_path, part)) for part in meta["segments"]]
+    if any(f is None for f in frames):
+        return None
+    try:
+        return _concat_frames(frames)
+    except (TypeError, ValueError):
+        # Segments that cannot be merged: the caller reparses the CSV and rewrites the sidecar
+        return None
+
+
+def _append_tail(csv_path: str, meta: dict) -> pd.DataFrame | None:
+    """Parse only the rows appended after meta["size"] and extend the sidecars."""
+    base = _read_segments(csv_path, meta)
+    if base is None:
+        return None
+    with open(csv_path, "rb") as f:
+        f.seek(meta["size"])
+        tail = f.read()
+    # A writer may be mid-line: leave an incomplete last line for the next load
+    end = tail.rfind(b"\n") + 1
+    if end == 0:
+        return base
+
+    try:
+        new = _derive_columns(pd.read_csv(
+            io.BytesIO(tail[:end]), header=None, names=meta["columns"], dtype=_CATEGORICAL_DTYPES,
+        ))
+        df = _concat_frames([base, new])
+    except (TypeError, ValueError):
+        # Tail that does not line up with the cached frame: reparse the whole CSV
+        return None
+    try:
+        if len(meta["segments"]) >= SIDECAR_MAX_SEGMENTS:
+            _write_frame(df, _sidecar_file(csv_path, ""))
+            meta["segments"] = [""]
+            _remove_segments(csv_path)
+        else:
+            part = f"seg{len(meta['segments'])}"
+            _write_frame(new, _sidecar_file(csv_path, part))
+            meta["segments"].append(part)
+        # Only the cube groups that received new rows change
+        cube = _read_frame(_sidecar_file(csv_path, "agg"))
+        cube = build_agg_cube(df) if cube is None else merge_agg_cubes(cube, build_agg_cube(new))
+        _write_frame(cube, _sidecar_file(csv_path, "agg"))
+
+        size = meta["size"] + end
+        meta.update(_offset_meta(csv_path, size), rows=meta["rows"] + len(new))
+        _write_json_atomic(_meta_path(csv_path), meta)
+    except OSError:
+        # Read-only dataset directory: the frame is still correct, just not cached
+        pass
+    return df
+
+
+def _offset_meta(csv_path: str, size: int) -> dict:
+    # Everything that describes the first `size` bytes of the CSV
+    head, tail = _boundary_hashes(csv_path, size)
+    with open(csv_path, "rb") as f:
+        f.seek(max(0, size - 1))
+        ends_with_newline = f.read(1) == b"\n"
+    return {
+        "size": size,
+        "mtime_ns": os.stat(csv_path).st_mtime_ns,
+        "sha256": _file_sha256(csv_path, limit=size),
+        "head_sha256": head,
+        "tail_sha256": tail,
+        "ends_with_newline": ends_with_newline,
+    }
+
+
+def _write_sidecar(csv_path: str, df: pd.DataFrame) -> None:
+    meta = {
+        "version": SIDECAR_VERSION,
+        "format": SIDECAR_FORMAT,
+        "rows": len(df),
+        "columns": pd.read_csv(csv_path, nrows=0).columns.tolist(),
+        "segments": [""],
+        **_offset_meta(csv_path, os.stat(csv_path).st_size),
+    }
+    try:
+        _write_frame(df, _sidecar_file(csv_path, ""))
+        _write_frame(build_agg_cube(df), _sidecar_file(csv_path, "agg"))
+        _write_json_atomic(_meta_path(csv_path), meta)
+        _remove_segments(csv_path)
+    except OSError:
+        # Read-only dataset directory: just skip caching
+        pass
+
+
+def _remove_segments(csv_path: str) -> None:
+    # Appended segments left over from before a compaction or full reparse
+    for path in Path(csv_path).parent.glob(glob.escape(Path(csv_path).name) + ".seg*"):
+        path.unlink(missing_ok=True)
+
+
+def _write_json_atomic(path: Path, obj: dict) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(obj), encoding="utf-8")
+    os.replace(tmp_path, path)
+
 # === Helpers ===
 def make_schema_text(df: pd.DataFrame) -> str:
     """Return a human-readable schema from a DataFrame."""
@@ -88,6 +522,102 @@ def ensure_execute_python_tags(text: str) -> str:
         text = f"<execute_python>\n{text}\n</execute_python>"
     return text
 
+# === Image Preprocessing ===
+# Reflection only needs a readable chart, not the 300-dpi original: vision APIs
+# downscale large images anyway, so shrink before uploading.
+REFLECTION_IMAGE_MAX_SIDE = int(os.getenv("REFLECTION_IMAGE_MAX_SIDE", "1568"))
+REFLECTION_IMAGE_FORMAT = os.getenv("REFLECTION_IMAGE_FORMAT", "PNG").upper()  # PNG | WEBP | JPEG
+REFLECTION_IMAGE_QUALITY = int(os.getenv("REFLECTION_IMAGE_QUALITY", "90"))  # WEBP/JPEG only
+
+_IMAGE_CACHE_SIZE = 64
+_image_cache: "OrderedDict[tuple, tuple[str, bytes, str]]" = OrderedDict()
+_image_cache_lock = threading.Lock()
+
+
+def prepare_image(
+    path: str | bytes,
+    max_side: int | None = None,
+    fmt: str | None = None,
+) -> tuple[str, bytes, str]:
+    """
+    Return (media_type, raw_bytes, base64_str) for a chart, downscaled so its
+    longest side is at most max_side and optionally re-encoded as WEBP/JPEG.
+    `path` may also be the PNG bytes of an in-memory preview render.
+    Results are cached by file content hash and settings.
+    """
+    if isinstance(path, bytes):
+        return prepare_image_bytes(path, max_side=max_side, fmt=fmt)
+    with open(path, "rb") as f:
+        return prepare_image_bytes(f.read(), max_side=max_side, fmt=fmt)
+
+
+def prepare_image_bytes(
+    data: bytes,
+    max_side: int | None = None,
+    fmt: str | None = None,
+) -> tuple[str, bytes, str]:
+    """Same as prepare_image, for an image that is already in memory."""
+    max_side = max_side or REFLECTION_IMAGE_MAX_SIDE
+    fmt = (fmt or REFLECTION_IMAGE_FORMAT).upper()
+    key = (hashlib.sha256(data).hexdigest(), max_side, fmt, REFLECTION_IMAGE_QUALITY)
+
+    with _image_cache_lock:
+        if key in _image_cache:
+            _image_cache.move_to_end(key)
+            return _image_cache[key]
+
+    payload = _downscale_and_encode(data, max_side, fmt)
+    with _image_cache_lock:
+        _image_cache[key] = payload
+        while len(_image_cache) > _IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+    return payload
+
+
+def _downscale_and_encode(data: bytes, max_side: int, fmt: str) -> tuple[str, bytes, str]:
+    import io
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    needs_resize = max(image.size) > max_side
+    if needs_resize or image.format != fmt:
+        if needs_resize:
+            image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buf = io.BytesIO()
+        save_kwargs = {"quality": REFLECTION_IMAGE_QUALITY} if fmt in ("JPEG", "WEBP") else {}
+        image.save(buf, format=fmt, **save_kwargs)
+        data = buf.getvalue()
+    media_type = f"image/{fmt.lower()}"
+    return media_type, data, base64.b64encode(data).decode("utf-8")
+
+
+def image_similarity(path_a: str | bytes, path_b: str | bytes, width: int = 256) -> float:
+    """
+    Cheap visual similarity in [0, 1] between two renders (file paths or PNG bytes).
+
+    Both images are downscaled to `width` pixels wide; the score is the share of
+    "ink" (non-background) pixels whose colour did not change noticeably.
+    Identical charts score 1.0; a retitled or recoloured chart drops well below 0.995.
+    """
+    import numpy as np
+    from PIL import Image
+
+    def load(path: str | bytes, size: tuple[int, int] | None = None):
+        with Image.open(io.BytesIO(path) if isinstance(path, bytes) else path) as image:
+            rgb = image.convert("RGB")
+            if size is None:
+                size = (width, max(1, round(rgb.height * width / rgb.width)))
+            return np.asarray(rgb.resize(size, Image.BILINEAR), dtype=np.int16), size
+
+    a, size = load(path_a)
+    b, _ = load(path_b, size)
+    ink = (a.min(axis=2) < 245) | (b.min(axis=2) < 245)
+    changed = (np.abs(a - b).max(axis=2) > 24) & ink
+    return float(1.0 - changed.sum() / max(1, ink.sum()))
+
+
 def encode_image_b64(path: str) -> tuple[str, str]:
     """Return (media_type, base64_str) for an image file path."""
     mime, _ = mimetypes.guess_type(path)
@@ -97,10 +627,7 @@ def encode_image_b64(path: str) -> tuple[str, str]:
     return media_type, b64
 
 
-import base64
-from IPython.display import HTML, display
-import pandas as pd
-from typing import Any
+from typing import Any, Iterator
 
 def print_html(content: Any, title: str | None = None, is_image: bool = False):
     """
@@ -109,6 +636,8 @@ def print_html(content: Any, title: str | None = None, is_image: bool = False):
     - If content is a pandas DataFrame/Series: render as an HTML table.
     - Otherwise (strings/others): show as code/text in <pre><code>.
     """
+    from IPython.display import HTML, display
+
     try:
         from html import escape as _escape
     except ImportError:
@@ -186,12 +715,8 @@ def print_html(content: Any, title: str | None = None, is_image: bool = False):
     
 
     
-def image_anthropic_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
-    """
-    Call Anthropic Claude (messages.create) with text+image and return *all* text blocks concatenated.
-    Adds a system message to enforce strict JSON output.
-    """
-    msg = anthropic_client.messages.create(
+def _anthropic_image_request(model_name: str, prompt: str, media_type: str, b64: str) -> dict:
+    return dict(
         model=model_name,
         max_tokens=2000,
         temperature=0,
@@ -208,6 +733,8 @@ def image_anthropic_call(model_name: str, prompt: str, media_type: str, b64: str
         }],
     )
 
+
+def _anthropic_text(msg) -> str:
     # Anthropic returns a list of content blocks; collect all text
     parts = []
     for block in (msg.content or []):
@@ -216,46 +743,305 @@ def image_anthropic_call(model_name: str, prompt: str, media_type: str, b64: str
     return "".join(parts).strip()
 
 
-def image_openai_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
+def _openai_image_input(prompt: str, media_type: str, b64: str) -> list:
     data_url = f"data:{media_type};base64,{b64}"
-    resp = openai_client.responses.create(
-        model=model_name,
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                    {"type": "input_image", "image_url": data_url},
-                ],
-            }
-        ],
-    )
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": prompt},
+                {"type": "input_image", "image_url": data_url},
+            ],
+        }
+    ]
+
+
+def _gemini_config(**kwargs):
+    from google.genai import types
+    return types.GenerateContentConfig(**kwargs)
+
+
+def _gemini_image(media_type: str, b64: str, image_bytes: bytes | None = None):
+    from google.genai import types
+
+    # Gemini takes raw bytes; only decode base64 when the caller has nothing else
+    if image_bytes is None:
+        image_bytes = base64.b64decode(b64)
+    return types.Part.from_bytes(data=image_bytes, mime_type=media_type)
+
+
+@tracing.llm_call("image", "anthropic")
+@fake_llm.recorded("image")
+@resilience.retrying
+def image_anthropic_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
+    """
+    Call Anthropic Claude (messages.create) with text+image and return *all* text blocks concatenated.
+    Adds a system message to enforce strict JSON output.
+    """
+    with clients.slot("anthropic"):
+        msg = clients.client("anthropic").messages.create(
+            **_anthropic_image_request(model_name, prompt, media_type, b64)
+        )
+    tracing.record_usage(msg)
+    return _anthropic_text(msg)
+
+
+@tracing.llm_call("image", "openai")
+@fake_llm.recorded("image")
+@resilience.retrying
+def image_openai_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
+    with clients.slot("openai"):
+        resp = clients.client("openai").responses.create(
+            model=model_name,
+            input=_openai_image_input(prompt, media_type, b64),
+        )
+    tracing.record_usage(resp)
     content = (resp.output_text or "").strip()
     return content
 
 
-def image_gemini_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
+@tracing.llm_call("image", "gemini")
+@fake_llm.recorded("image")
+@resilience.retrying
+def image_gemini_call(
+    model_name: str, prompt: str, media_type: str, b64: str, image_bytes: bytes | None = None
+) -> str:
     """
     Call Google Gemini with text+image and return the response using new SDK.
     """
-    import io
+    image = _gemini_image(media_type, b64, image_bytes)
 
-    if not gemini_client:
-        raise ValueError("Gemini client not initialized. Please set GOOGLE_API_KEY in .env")
+    # Use new SDK: client.models.generate_content()
+    with clients.slot("gemini"):
+        response = clients.client("gemini").models.generate_content(
+            model=model_name,
+            contents=[image, prompt],
+            config=_gemini_config(
+                temperature=0.1
+            )
+        )
 
-    # Decode base64 to bytes
-    image_bytes = base64.b64decode(b64)
+    tracing.record_usage(response)
+    return response.text.strip()
 
-    # Open image with PIL
-    image = Image.open(io.BytesIO(image_bytes))
 
-    # Use new SDK: client.models.generate_content()
-    response = gemini_client.models.generate_content(
-        model=model_name,
-        contents=[image, prompt],
-        config=genai.types.GenerateContentConfig(
-            temperature=0.1
+# === Streaming variants (used by chart_workflow.reflect_on_image_and_regenerate_stream) ===
+# Providers report output tokens only at the end of a stream; when the caller
+# closes it early just the input tokens are recorded and the trace summary
+# flags the stage as partial
+@tracing.llm_call("stream", "anthropic")
+@fake_llm.recorded("image")
+@resilience.retrying
+def stream_anthropic_call(model_name: str, prompt: str, media_type: str, b64: str) -> Iterator[str]:
+    """Yield text deltas from Claude as they arrive; closing the generator closes the stream."""
+    request = _anthropic_image_request(model_name, prompt, media_type, b64)
+    completed = False
+    with clients.slot("anthropic"), clients.client("anthropic").messages.stream(**request) as stream:
+        try:
+            for text in stream.text_stream:
+                yield text
+            completed = True
+        finally:
+            try:
+                usage = stream.current_message_snapshot.usage
+            except Exception:  # closed before message_start arrived
+                usage = None
+            if usage is not None:
+                tracing.annotate(
+                    input_tokens=usage.input_tokens,
+                    output_tokens=usage.output_tokens if completed else None,
+                )
+
+
+@tracing.llm_call("stream", "openai")
+@fake_llm.recorded("image")
+@resilience.retrying
+def stream_openai_call(model_name: str, prompt: str, media_type: str, b64: str) -> Iterator[str]:
+    """Yield output_text deltas from the OpenAI Responses streaming API."""
+    with clients.slot("openai"):
+        stream = clients.client("openai").responses.create(
+            model=model_name,
+            input=_openai_image_input(prompt, media_type, b64),
+            stream=True,
         )
-    )
+        try:
+            for event in stream:
+                if event.type == "response.output_text.delta":
+                    yield event.delta
+                elif event.type == "response.completed":
+                    tracing.record_usage(event.response)
+        finally:
+            stream.close()
+
+
+@tracing.llm_call("stream", "gemini")
+@fake_llm.recorded("image")
+@resilience.retrying
+def stream_gemini_call(
+    model_name: str, prompt: str, media_type: str, b64: str, image_bytes: bytes | None = None
+) -> Iterator[str]:
+    """Yield text chunks from Gemini's generate_content_stream."""
+    image = _gemini_image(media_type, b64, image_bytes)
+    last = None
+    with clients.slot("gemini"):
+        for chunk in clients.client("gemini").models.generate_content_stream(
+            model=model_name,
+            contents=[image, prompt],
+            config=_gemini_config(temperature=0.1),
+        ):
+            last = chunk
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage is not None:
+                tracing.annotate(input_tokens=usage.prompt_token_count)
+            if chunk.text:
+                yield chunk.text
+    # Only the final chunk's candidate count covers the whole reply
+    if last is not None:
+        tracing.record_usage(last)
+
+
+# === Offline fake backend (fake:replay / fake:scripted) ===
+@tracing.llm_call("image", "fake")
+def image_fake_call(
+    model_name: str, prompt: str, media_type: str, b64: str, image_bytes: bytes | None = None
+) -> str:
+    """Same signature as the real image calls; the chart itself is ignored."""
+    return fake_llm.complete(model_name, prompt, kind="image").strip()
+
+
+@tracing.llm_call("stream", "fake")
+def stream_fake_call(
+    model_name: str, prompt: str, media_type: str, b64: str, image_bytes: bytes | None = None
+) -> Iterator[str]:
+    yield from fake_llm.stream(model_name, prompt, kind="image")
+
+
+@tracing.llm_call("image", "fake")
+async def aimage_fake_call(
+    model_name: str, prompt: str, media_type: str, b64: str, image_bytes: bytes | None = None
+) -> str:
+    return (await fake_llm.acomplete(model_name, prompt, kind="image")).strip()
+
+
+# === Async variants (used by chart_workflow.arun_workflows) ===
+@tracing.llm_call("text", provider_for)
+@fake_llm.recorded("text")
+async def aget_response(
+    model: str,
+    prompt: str,
+    temperature: float | None = None,
+    use_cache: bool = True,
+    hedge_model: str | None = None,
+) -> str:
+    """Async twin of get_response; shares the same on-disk cache, retries and hedging."""
+    use_cache = use_cache and CACHE_ENABLED
+    # The cache is SQLite behind a lock, so its reads and writes run off the event loop
+    if use_cache:
+        cached = await asyncio.to_thread(response_cache.get, _text_cache_key(model, prompt, temperature))
+        if cached is not None:
+            tracing.annotate(cached=True)
+            return cached
+
+    hedge_model = hedge_model or HEDGE_MODELS.get(model)
+    answered_by = model
+    if hedge_model:
+        # The losing request is cancelled
+        text, used_backup = await resilience.ahedged_call(
+            lambda: _atimed_call(model, prompt, temperature),
+            lambda: _atimed_call(hedge_model, prompt, temperature),
+            after=latency.hedge_after(model),
+        )
+        if used_backup:
+            answered_by = hedge_model
+            tracing.annotate(hedged_by=hedge_model)
+    else:
+        text = await _atimed_call(model, prompt, temperature)
+
+    if use_cache:
+        await asyncio.to_thread(response_cache.set, _text_cache_key(answered_by, prompt, temperature), text)
+    return text
+
+
+async def _atimed_call(model: str, prompt: str, temperature: float | None) -> str:
+    provider, temperature = _text_request(model, temperature)
+    start = time.perf_counter()
+    text = await _acall_provider(provider, model, prompt, temperature)
+    latency.record(model, time.perf_counter() - start)
+    return text
+
+
+@resilience.retrying
+async def _acall_provider(provider: str, model: str, prompt: str, temperature: float | None) -> str:
+    if provider == "fake":
+        return await fake_llm.acomplete(model, prompt)
+
+    extra = {"temperature": temperature} if temperature is not None else {}
+    client = clients.async_client(provider)
+    if provider == "anthropic":
+        async with clients.aslot(provider):
+            message = await client.messages.create(
+                model=model,
+                max_tokens=1000,
+                messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+                **extra,
+            )
+        tracing.record_usage(message)
+        return message.content[0].text
+
+    elif provider == "gemini":
+        async with clients.aslot(provider):
+            response = await client.models.generate_content(
+                model=model,
+                contents=[prompt],
+                config=_gemini_config(**extra),
+            )
+        tracing.record_usage(response)
+        return response.text
 
-    return response.text.strip()
\ No newline at end of file
+    else:
+        async with clients.aslot(provider):
+            response = await client.responses.create(model=model, input=prompt, **extra)
+        tracing.record_usage(response)
+        return response.output_text
+
+
+@tracing.llm_call("image", "anthropic")
+@fake_llm.recorded("image")
+@resilience.retrying
+async def aimage_anthropic_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
+    async with clients.aslot("anthropic"):
+        msg = await clients.async_client("anthropic").messages.create(
+            **_anthropic_image_request(model_name, prompt, media_type, b64)
+        )
+    tracing.record_usage(msg)
+    return _anthropic_text(msg)
+
+
+@tracing.llm_call("image", "openai")
+@fake_llm.recorded("image")
+@resilience.retrying
+async def aimage_openai_call(model_name: str, prompt: str, media_type: str, b64: str) -> str:
+    async with clients.aslot("openai"):
+        resp = await clients.async_client("openai").responses.create(
+            model=model_name,
+            input=_openai_image_input(prompt, media_type, b64),
+        )
+    tracing.record_usage(resp)
+    return (resp.output_text or "").strip()
+
+
+@tracing.llm_call("image", "gemini")
+@fake_llm.recorded("image")
+@resilience.retrying
+async def aimage_gemini_call(
+    model_name: str, prompt: str, media_type: str, b64: str, image_bytes: bytes | None = None
+) -> str:
+    image = _gemini_image(media_type, b64, image_bytes)
+    async with clients.aslot("gemini"):
+        response = await clients.async_client("gemini").models.generate_content(
+            model=model_name,
+            contents=[image, prompt],
+            config=_gemini_config(temperature=0.1),
+        )
+    tracing.record_usage(response)
+    return response.text.strip()
@@ -0,0 +1,239 @@
+"""
+离线的假 LLM 后端 - 不联网、结果确定，用于压测数据库、缓存与并发改动
+按模型名选择：
+  - fake:replay    回放 LLM_RECORD=1 时录制到 LLM_RECORD_PATH 的真实回复（按 kind + 提示词哈希精确匹配，
+                   未命中时按录制顺序轮流返回同类回复）
+  - fake:scripted  返回内置的固定回复（V1 SQL 故意漏掉 action 过滤，反思时修正）
+模型名后可跟注入的延迟毫秒数，例如 fake:scripted:800；也可用 LLM_FAKE_LATENCY_MS /
+LLM_FAKE_JITTER_MS 统一设置。抖动由提示词哈希决定，同一提示词每次延迟相同。
+
+图表实验（2.4）有一份 fake_llm.py：除本模块说明与「脚本化回复」一节外两份逐字相同，
+修改公共部分后在上级目录运行 python check_lab_twins.py 校验
+"""
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import inspect
+import functools
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterator
+
+import tracing
+
+FAKE_PREFIX = "fake:"
+MODES = ("replay", "scripted")
+
+# LLM_RECORD=1 时，对真实模型的每次调用都会把回复追加到 RECORD_PATH，供 fake:replay 回放
+RECORD_ENABLED = os.getenv("LLM_RECORD", "0") == "1"
+RECORD_PATH = os.getenv("LLM_RECORD_PATH", ".cache/llm_recording.jsonl")
+
+FAKE_LATENCY_MS = float(os.getenv("LLM_FAKE_LATENCY_MS", "0"))
+FAKE_JITTER_MS = float(os.getenv("LLM_FAKE_JITTER_MS", "0"))
+# 流式回放时每个分块的字符数与分块间隔
+STREAM_CHUNK_CHARS = 40
+STREAM_CHUNK_MS = float(os.getenv("LLM_FAKE_CHUNK_MS", "0"))
+
+
+def is_fake(model: str) -> bool:
+    return model.lower().startswith(FAKE_PREFIX)
+
+
+def parse_model(model: str) -> tuple[str, float]:
+    """"fake:<mode>[:<latency_ms>]" -> (mode, 基础延迟秒数)。"""
+    parts = model.split(":")
+    mode = parts[1] if len(parts) > 1 else ""
+    if mode not in MODES:
+        raise ValueError(f"Unknown fake model {model!r}; use one of: " + ", ".join(FAKE_PREFIX + m for m in MODES))
+    latency_ms = float(parts[2]) if len(parts) > 2 and parts[2] else FAKE_LATENCY_MS
+    return mode, latency_ms / 1000
+
+
+def prompt_key(kind: str, prompt: str) -> str:
+    return hashlib.sha256(f"{kind}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def _delay(model: str, prompt: str) -> float:
+    _, base = parse_model(model)
+    if not FAKE_JITTER_MS:
+        return base
+    rng = random.Random(prompt_key("latency", prompt))
+    return max(0.0, base + rng.uniform(-FAKE_JITTER_MS, FAKE_JITTER_MS) / 1000)
+
+
+# ----------------------------------------------------------------------
+# 录制与回放
+# ----------------------------------------------------------------------
+
+class Recording:
+    """
+    录制文件的内存索引。
+
+    参数:
+        path: LLM_RECORD_PATH 写出的 JSONL，每行 {"kind", "model", "key", "response"}
+    """
+
+    def __init__(self, path: str = RECORD_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._by_key = None
+        self._by_kind = None
+        self._cursor = defaultdict(int)
+
+    def _load(self) -> None:
+        by_key, by_kind = {}, defaultdict(list)
+        if Path(self.path).exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        by_key[entry["key"]] = entry["response"]
+                        # 早期的 SQL 实验录制没有 kind 字段，统一视为 text
+                        by_kind[entry.get("kind", "text")].append(entry["response"])
+        self._by_key, self._by_kind = by_key, by_kind
+
+    def lookup(self, kind: str, prompt: str) -> str:
+        with self._lock:
+            if self._by_key is None:
+                self._load()
+            hit = self._by_key.get(prompt_key(kind, prompt))
+            if hit is not None:
+                return hit
+            # 提示词里带有输出路径等易变内容，精确匹配不到时按顺序轮流回放同类回复
+            responses = self._by_kind.get(kind)
+            if not responses:
+                raise LookupError(
+                    f"No recorded {kind!r} responses in {self.path}; "
+                    "run once with LLM_RECORD=1 against a real model, or use fake:scripted"
+                )
+            response = responses[self._cursor[kind] % len(responses)]
+            self._cursor[kind] += 1
+            return response
+
+    def append(self, kind: str, model: str, prompt: str, response: str) -> None:
+        entry = {"kind": kind, "model": model, "key": prompt_key(kind, prompt), "response": response}
+        with self._lock:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            if self._by_key is not None:
+                self._by_key[entry["key"]] = response
+                self._by_kind[kind].append(response)
+
+
+recording = Recording()
+
+
+def recorded(kind: str):
+    """
+    LLM_RECORD=1 时，把被装饰函数（第一个参数为模型名，第二个为提示词）对真实模型的回复录制下来。
+    同步函数、协程函数与生成器函数（流式，录制拼接后的全文）均可装饰。
+    """
+    def should_record(args) -> bool:
+        return RECORD_ENABLED and not is_fake(args[0])
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                result = await fn(*args, **kwargs)
+                if should_record(args):
+                    recording.append(kind, args[0], args[1], result)
+                return result
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                # 反思流在读到完整代码后会被调用方提前关闭，此时已产出的部分同样录制
+                parts = []
+                chunks = fn(*args, **kwargs)
+                try:
+                    for chunk in chunks:
+                        parts.append(chunk)
+                        yield chunk
+                except GeneratorExit:
+                    pass
+                finally:
+                    chunks.close()
+                if parts and should_record(args):
+                    recording.append(kind, args[0], args[1], "".join(parts))
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            if should_record(args):
+                recording.append(kind, args[0], args[1], result)
+            return result
+        return wrapper
+
+    return decorate
+
+
+# ----------------------------------------------------------------------
+# 脚本化回复
+# ----------------------------------------------------------------------
+
+_SQL_V1 = (
+    "SELECT color, SUM(qty_delta * unit_price) AS total_sales "
+    "FROM transactions GROUP BY color ORDER BY total_sales DESC LIMIT 1;"
+)
+_SQL_V2 = (
+    "SELECT color, SUM(-qty_delta * unit_price) AS total_sales "
+    "FROM transactions WHERE action = 'sale' GROUP BY color ORDER BY total_sales DESC LIMIT 1;"
+)
+
+
+def scripted_response(kind: str, prompt: str) -> str:
+    """
+    两次调用都是 text 类型，按提示词区分：生成提示词返回 V1 SQL；
+    反思提示词（要求返回 refined_sql）返回反馈 JSON 与修正后的 SQL。
+    """
+    if "refined_sql" not in prompt:
+        return _SQL_V1
+    return json.dumps({
+        "feedback": "Only 'sale' events are revenue and their qty_delta is negative; filter and flip the sign.",
+        "refined_sql": _SQL_V2,
+    })
+
+
+# ----------------------------------------------------------------------
+# 调用入口
+# ----------------------------------------------------------------------
+
+def _respond(model: str, prompt: str, kind: str) -> str:
+    mode, _ = parse_model(model)
+    text = recording.lookup(kind, prompt) if mode == "replay" else scripted_response(kind, prompt)
+    # 粗略按 4 字符 / token 估算，让追踪汇总里的 token 列也有数据
+    span = tracing.current_span()
+    if span is not None and span.name == tracing.LLM_SPAN:
+        span.set(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4)
+    return text
+
+
+def complete(model: str, prompt: str, kind: str = "text") -> str:
+    """同步调用：等待注入的延迟后返回回复。"""
+    time.sleep(_delay(model, prompt))
+    return _respond(model, prompt, kind)
+
+
+async def acomplete(model: str, prompt: str, kind: str = "text") -> str:
+    await asyncio.sleep(_delay(model, prompt))
+    return _respond(model, prompt, kind)
+
+
+def stream(model: str, prompt: str, kind: str = "image") -> Iterator[str]:
+    """流式调用：注入的延迟作为首个分块的等待时间，之后按 STREAM_CHUNK_CHARS 分块产出。"""
+    time.sleep(_delay(model, prompt))
+    text = _respond(model, prompt, kind)
+    for i in range(0, len(text), STREAM_CHUNK_CHARS):
+        if i and STREAM_CHUNK_MS:
+            time.sleep(STREAM_CHUNK_MS / 1000)
+        yield text[i:i + STREAM_CHUNK_CHARS]
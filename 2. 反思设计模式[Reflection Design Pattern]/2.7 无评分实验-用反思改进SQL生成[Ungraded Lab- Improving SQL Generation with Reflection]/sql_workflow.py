@@ -7,11 +7,31 @@ import json
 import pandas as pd
 import aisuite as ai
 import utils
+import tracing
+import fake_llm
 
 # 初始化 aisuite 客户端
 client = ai.Client()
 
 
+@tracing.llm_call("text", provider=lambda model: model.split(":", 1)[0])
+@fake_llm.recorded("text")
+def _complete(model: str, prompt: str) -> str:
+    """
+    调用一次 aisuite 对话接口（temperature=0），记录 token 用量并返回去除首尾空白的回复。
+    fake:replay / fake:scripted 走离线后端（见 fake_llm.py），不联网。
+    """
+    if fake_llm.is_fake(model):
+        return fake_llm.complete(model, prompt).strip()
+    response = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,
+    )
+    tracing.record_usage(response)
+    return response.choices[0].message.content.strip()
+
+
 # ============================================================================
 # 第1部分：SQL生成函数
 # ============================================================================
@@ -42,12 +62,7 @@ def generate_sql(question: str, schema: str, model: str) -> str:
 2. 不要使用Markdown代码块标记（不要```sql 或 ```）
 3. 直接返回可执行的SQL代码
 """
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0,
-    )
-    return response.choices[0].message.content.strip()
+    return _complete(model, prompt)
 
 
 # ============================================================================
@@ -95,13 +110,7 @@ def refine_sql(
   "refined_sql": "<final SQL to run>"
 }}
 """
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0,
-    )
-
-    content = response.choices[0].message.content.strip()
+    content = _complete(model, prompt)
 
     # 清理 Markdown 代码块标记
     content = content.replace("```json", "").replace("```", "").strip()
@@ -135,7 +144,7 @@ def refine_sql_external_feedback(
     参数:
         question: 用户问题
         sql_query: 原始 SQL 查询
-        df_feedback: SQL 执行后的实际结果（DataFrame）
+        df_feedback: SQL 执行后的实际结果（DataFrame）；结果较大时只放入摘要（见 utils.summarize_result）
         schema: 数据库架构
         model: LLM 模型名称
 
@@ -152,7 +161,7 @@ def refine_sql_external_feedback(
 {sql_query}
 
 SQL 输出：
-{df_feedback.to_markdown(index=False)}
+{utils.summarize_result(df_feedback)}
 
 表架构：
 {schema}
@@ -169,13 +178,7 @@ SQL 输出：
 - "refined_sql": 需要执行的最终 SQL
 """
 
-    response = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0,
-    )
-
-    content = response.choices[0].message.content.strip()
+    content = _complete(model, prompt)
 
     # 清理 Markdown 代码块标记
     content = content.replace("```json", "").replace("```", "").strip()
@@ -201,11 +204,32 @@ SQL 输出：
 # 第3部分：完整工作流函数
 # ============================================================================
 
+def same_sql(a: str, b: str) -> bool:
+    """
+    两条 SQL 规范化后（见 utils.normalize_sql）是否相同；相同则结果的数据一致，
+    但没有别名的列名取自表达式原文，可能因空白、大小写不同而不同（见 reuse_result）。
+    """
+    return utils.normalize_sql(a) == utils.normalize_sql(b)
+
+
+def reuse_result(df: pd.DataFrame, sql: str, db_path: str) -> pd.DataFrame | None:
+    """
+    把等价查询的结果 df 改用 sql 自己的列名返回（不读取数据行）；
+    取不到列名或列数不一致时返回 None，调用方应改为直接执行。
+    """
+    columns = utils.query_columns(sql, db_path)
+    if columns is None or len(columns) != len(df.columns):
+        return None
+    return df.set_axis(columns, axis=1)
+
+
+@tracing.trace_workflow("run_workflow")
 def run_workflow(
     db_path: str,
     question: str,
     generation_model: str,
     evaluation_model: str,
+    max_rounds: int = 1,
 ):
     """
     端到端自动化工作流：生成、执行、评估并改进 SQL 查询
@@ -217,15 +241,25 @@ def run_workflow(
       4) 结合执行反馈反思 V1 → 提出改进版 SQL（V2）
       5) 执行 V2 → 展示最终答案
 
+    反思返回的 SQL 与上一版等价（same_sql）时不再执行，直接复用上一版的结果
+    （按新 SQL 的列名重新标注，见 reuse_result），并视为已收敛；
+    max_rounds > 1 时会继续以新结果反思，直到收敛或轮数用完。
+
     参数:
         db_path: 数据库文件路径
         question: 用户的自然语言问题
         generation_model: 用于生成SQL的模型
         evaluation_model: 用于评估和改进的模型
+        max_rounds: 最多反思轮数（默认 1，即只生成 V2），至少为 1
 
     返回:
-        包含所有产物（SQL、反馈、结果）的字典
+        包含所有产物（SQL、反馈、结果）的字典，sql_v2 / result_v2 为最后一版；
+        rounds 记录每轮的 SQL、反馈与是否复用了上一版结果，converged 表示是否在轮数内收敛；
+        trace_id 对应 tracing 导出的 span（结束时会打印各阶段耗时与 token 汇总）
     """
+    if max_rounds < 1:
+        raise ValueError(f"max_rounds must be >= 1, got {max_rounds}")
+
     print("\n" + "="*70)
     print("🚀 启动 SQL 反思工作流")
     print("="*70)
@@ -233,7 +267,8 @@ def run_workflow(
 
     # 1) 提取数据库架构
     print("📘 步骤 1：提取数据库架构...")
-    schema = utils.get_schema(db_path)
+    with tracing.span("schema"):
+        schema = utils.get_schema(db_path)
     print(f"✓ 架构提取成功")
     print(f"  {schema}")
     print()
@@ -241,51 +276,74 @@ def run_workflow(
     # 2) 生成 SQL（V1）
     print("🧠 步骤 2：生成 SQL（V1）...")
     print(f"  使用模型：{generation_model}")
-    sql_v1 = generate_sql(question, schema, generation_model)
+    with tracing.span("generate_v1"):
+        sql_v1 = generate_sql(question, schema, generation_model)
     print(f"✓ V1生成成功")
     print(f"  SQL: {sql_v1}")
     print()
 
     # 3) 执行 V1
     print("🧪 步骤 3：执行 V1（SQL 输出）...")
-    df_v1 = utils.execute_sql(sql_v1, db_path)
+    with tracing.span("execute_v1"):
+        df_v1 = utils.execute_sql(sql_v1, db_path)
     print(f"✓ V1执行完成")
     print(df_v1)
     print()
 
-    # 4) 结合执行反馈反思 V1 → 提出改进版 SQL（V2）
-    print("🧭 步骤 4：反思 V1（基于执行结果的反馈）...")
-    print(f"  使用模型：{evaluation_model}")
-    feedback, sql_v2 = refine_sql_external_feedback(
-        question=question,
-        sql_query=sql_v1,
-        df_feedback=df_v1,  # 外部反馈：V1 的执行结果
-        schema=schema,
-        model=evaluation_model,
-    )
-    print(f"✓ 反思完成")
-    print(f"  反馈: {feedback}")
-    print()
-
-    print("🔁 步骤 5：改进后的 SQL（V2）...")
-    print(f"  SQL: {sql_v2}")
-    print()
-
-    # 5) 执行 V2 → 展示最终答案
-    print("✅ 步骤 6：执行 V2（最终答案）...")
-    df_v2 = utils.execute_sql(sql_v2, db_path)
-    print(f"✓ V2执行完成")
-    print(df_v2)
-    print()
+    sql_prev, df_prev = sql_v1, df_v1
+    rounds, converged = [], False
+    for version in range(1, max_rounds + 1):
+        # 4) 结合执行反馈反思上一版 → 提出改进版 SQL
+        print(f"🧭 步骤 4：反思 V{version}（基于执行结果的反馈）...")
+        print(f"  使用模型：{evaluation_model}")
+        with tracing.span(f"reflect_v{version}"):
+            feedback, sql_next = refine_sql_external_feedback(
+                question=question,
+                sql_query=sql_prev,
+                df_feedback=df_prev,  # 外部反馈：上一版的执行结果
+                schema=schema,
+                model=evaluation_model,
+            )
+        print(f"✓ 反思完成")
+        print(f"  反馈: {feedback}")
+        print()
+
+        print(f"🔁 步骤 5：改进后的 SQL（V{version + 1}）...")
+        print(f"  SQL: {sql_next}")
+        print()
+
+        # 5) 执行改进版 → 展示答案；与上一版等价时直接复用结果
+        df_next = reuse_result(df_prev, sql_next, db_path) if same_sql(sql_next, sql_prev) else None
+        converged = df_next is not None
+        if converged:
+            print(f"✅ 步骤 6：V{version + 1} 与 V{version} 等价，复用 V{version} 的结果")
+        else:
+            print(f"✅ 步骤 6：执行 V{version + 1}（最终答案）...")
+            with tracing.span(f"execute_v{version + 1}"):
+                df_next = utils.execute_sql(sql_next, db_path)
+            print(f"✓ V{version + 1}执行完成")
+        print(df_next)
+        print()
+
+        rounds.append({"sql": sql_next, "feedback": feedback, "reused": converged})
+        sql_prev, df_prev = sql_next, df_next
+        if converged:
+            break
 
     print("="*70)
     print("🎉 工作流完成！")
     print("="*70)
+    if converged:
+        print(f"🔂 反思在第 {len(rounds)} 轮收敛（SQL 不再变化）")
+    stats = utils.result_cache.stats()
+    print(f"🗃️  查询结果缓存：命中 {stats['hits']} 次，未命中 {stats['misses']} 次（命中率 {stats['hit_rate']:.0%}）")
 
     return {
         "sql_v1": sql_v1,
         "result_v1": df_v1,
-        "feedback": feedback,
-        "sql_v2": sql_v2,
-        "result_v2": df_v2,
+        "feedback": rounds[-1]["feedback"],
+        "sql_v2": sql_prev,
+        "result_v2": df_prev,
+        "rounds": rounds,
+        "converged": converged,
     }
@@ -0,0 +1,293 @@
+"""
+LLM 调用追踪 - 记录每个阶段的墙钟耗时、token 用量、模型与重试次数
+span 的字段沿用 OpenTelemetry 命名（traceId / spanId / parentSpanId / startTimeUnixNano ...），
+结束时逐行追加到本地 JSONL 文件；工作流结束时按阶段打印汇总表
+
+本文件在图表实验（2.4）与 SQL 实验（2.7）中各有一份：每个实验目录需能单独运行，因此不共享导入路径。
+两份必须逐字相同，修改后在上级目录运行 python check_lab_twins.py 校验
+"""
+
+import os
+import json
+import time
+import inspect
+import secrets
+import functools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+# span 导出位置，设为空字符串关闭导出（内存中的汇总不受影响）
+TRACE_PATH = os.getenv("LLM_TRACE_PATH", ".cache/traces.jsonl")
+# 内存中最多保留的 span 数，长时间批量运行时旧 span 会被丢弃
+MAX_SPANS = 10000
+
+LLM_SPAN = "llm"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """一个计时区间；attributes 中的 model / input_tokens / output_tokens / retries 参与汇总。"""
+
+    def __init__(self, name: str, parent: "Span | None", attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "OK"
+        self.error = None
+        self._t0 = time.perf_counter()
+        self.duration = 0.0
+
+    def set(self, **attributes) -> None:
+        """设置属性（值为 None 的忽略）。"""
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def add(self, **counts) -> None:
+        """累加数值属性，例如 add(retries=1)。"""
+        for k, v in counts.items():
+            if v:
+                self.attributes[k] = self.attributes.get(k, 0) + v
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._t0
+        self.end_ns = self.start_ns + int(self.duration * 1e9)
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.error},
+        }
+
+
+class Tracer:
+    """
+    收集 span，并在每个 span 结束时导出到 JSONL。
+
+    参数:
+        path: JSONL 导出路径，为空时只在内存中保留
+        max_spans: 内存中保留的 span 上限
+    """
+
+    def __init__(self, path: str | None = TRACE_PATH, max_spans: int = MAX_SPANS):
+        self.path = path
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, activate: bool = True, **attributes):
+        """
+        打开一个 span；嵌套调用自动建立父子关系。
+
+        activate=False 时不把该 span 设为当前 span（用于生成器等会跨上下文挂起的代码）。
+        """
+        parent = _current_span.get()
+        span = Span(name, parent, attributes)
+        token = _current_span.set(span) if activate else None
+        try:
+            yield span
+        except BaseException as e:
+            # 提前关闭流式生成器不算失败
+            if not isinstance(e, GeneratorExit):
+                span.status = "ERROR"
+                span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if token is not None:
+                _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        span.finish()
+        with self._lock:
+            self.spans.append(span)
+            if self.path:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def summary(self, root: Span) -> list[dict]:
+        """
+        按 root 的直接子 span（阶段）汇总，每个阶段累计其下所有 LLM 调用的 token 与重试。
+
+        返回:
+            [{"stage", "seconds", "share", "calls", "input_tokens", "output_tokens", "retries", "partial_usage", "models"}]
+        """
+        with self._lock:
+            spans = [s for s in self.spans if s.trace_id == root.trace_id]
+        children = {}
+        for s in spans:
+            children.setdefault(s.parent_id, []).append(s)
+
+        def descendants(span: Span):
+            yield span
+            for child in children.get(span.span_id, []):
+                yield from descendants(child)
+
+        rows = []
+        for stage in sorted(children.get(root.span_id, []), key=lambda s: s.start_ns):
+            llm = [s for s in descendants(stage) if s.name == LLM_SPAN]
+            rows.append({
+                "stage": stage.name,
+                "seconds": stage.duration,
+                "share": stage.duration / root.duration if root.duration else 0.0,
+                "calls": len(llm),
+                "input_tokens": sum(s.attributes.get("input_tokens", 0) for s in llm),
+                "output_tokens": sum(s.attributes.get("output_tokens", 0) for s in llm),
+                "retries": sum(s.attributes.get("retries", 0) for s in llm),
+                # 提前关闭的流式调用往往拿不到供应商在流末尾才给出的用量
+                "partial_usage": any(s.attributes.get("kind") == "stream" and "output_tokens" not in s.attributes for s in llm),
+                "models": sorted({s.attributes["model"] for s in llm if "model" in s.attributes}),
+                "status": stage.status,
+            })
+        return rows
+
+    def print_summary(self, root: Span) -> None:
+        """打印 root 下各阶段的耗时与 token 汇总表。"""
+        rows = self.summary(root)
+        print(f"\n⏱️  阶段耗时与 token 用量（trace {root.trace_id[:8]}，总计 {root.duration:.2f}s）")
+        header = f"  {'stage':<16}{'sec':>8}{'share':>8}{'calls':>7}{'in_tok':>9}{'out_tok':>9}{'retry':>7}  model"
+        print(header)
+        print("  " + "-" * (len(header) + 8))
+        for r in rows:
+            mark = "" if r["status"] == "OK" else " ✗"
+            out_tok = f"{r['output_tokens']}{'*' if r['partial_usage'] else ''}"
+            print(
+                f"  {r['stage']:<16}{r['seconds']:>8.2f}{r['share']:>8.0%}{r['calls']:>7}"
+                f"{r['input_tokens']:>9}{out_tok:>9}{r['retries']:>7}  {', '.join(r['models'])}{mark}"
+            )
+        if any(r["partial_usage"] for r in rows):
+            print("  * 含未取得完整 token 用量的流式调用（读到代码后提前关闭了流），token 数偏低")
+        if self.path:
+            print(f"  span 已写入 {self.path}")
+
+
+tracer = Tracer()
+
+
+def span(name: str, **attributes):
+    """tracer.span 的快捷方式。"""
+    return tracer.span(name, **attributes)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def annotate(**attributes) -> None:
+    """给当前 span 设置属性；没有活动 span 时忽略。"""
+    s = _current_span.get()
+    if s is not None:
+        s.set(**attributes)
+
+
+def record_usage(response) -> None:
+    """从任意供应商的响应对象中读取 token 用量，记到当前 span 上。"""
+    usage = getattr(response, "usage", None) or getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+
+    def first(*names):
+        for n in names:
+            value = getattr(usage, n, None)
+            if value is not None:
+                return value
+        return None
+
+    annotate(
+        # Anthropic / OpenAI Responses、OpenAI Chat Completions（aisuite）、Gemini 各自的字段名
+        input_tokens=first("input_tokens", "prompt_tokens", "prompt_token_count"),
+        output_tokens=first("output_tokens", "completion_tokens", "candidates_token_count"),
+    )
+
+
+def llm_call(kind: str, provider=None):
+    """
+    装饰一个 LLM 调用函数（第一个参数为模型名），为每次调用记录一个 "llm" span。
+
+    参数:
+        kind: 调用类型，例如 "text" / "image" / "stream"
+        provider: 供应商名称，或 model -> provider 的函数
+
+    同步函数、协程函数与生成器函数（流式）均可装饰；流式调用额外记录首个分块的延迟 ttft_ms。
+    流式调用的 span 只在生成器每次推进时设为当前 span，被装饰函数可以在流中途或结束时
+    用 record_usage / annotate 记录用量。
+    """
+    def attributes(args, kwargs) -> dict:
+        model = args[0] if args else kwargs.get("model", kwargs.get("model_name"))
+        name = provider(model) if callable(provider) else provider
+        return {"model": model, "provider": name, "kind": kind, "retries": 0}
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(LLM_SPAN, **attributes(args, kwargs)):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                # 生成器会在调用方的上下文之间挂起，因此不设为当前 span
+                with tracer.span(LLM_SPAN, activate=False, **attributes(args, kwargs)) as s:
+                    chunks = fn(*args, **kwargs)
+                    try:
+                        first = True
+                        while True:
+                            token = _current_span.set(s)
+                            try:
+                                chunk = next(chunks)
+                            except StopIteration:
+                                break
+                            finally:
+                                _current_span.reset(token)
+                            if first:
+                                s.set(ttft_ms=round((time.perf_counter() - s._t0) * 1000, 1))
+                                first = False
+                            yield chunk
+                    finally:
+                        token = _current_span.set(s)
+                        try:
+                            chunks.close()
+                        finally:
+                            _current_span.reset(token)
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(LLM_SPAN, **attributes(args, kwargs)):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def trace_workflow(name: str):
+    """
+    装饰工作流入口：整个调用作为一个 span，结束后打印阶段汇总，
+    返回值为字典时附上 trace_id 便于在 JSONL 中查找。
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name) as root:
+                result = fn(*args, **kwargs)
+            tracer.print_summary(root)
+            if isinstance(result, dict):
+                result["trace_id"] = root.trace_id
+            return result
+        return wrapper
+    return decorate
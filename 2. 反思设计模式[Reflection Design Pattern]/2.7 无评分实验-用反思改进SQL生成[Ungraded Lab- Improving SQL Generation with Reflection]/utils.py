@@ -1,16 +1,60 @@
+import os
+import re
 import sqlite3
 import random
+import itertools
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
 import pandas as pd
 
+try:
+    import sqlglot
+except ImportError:  # optional: normalize_sql falls back to the local tokenizer
+    sqlglot = None
+
+SEED_BRANDS = ["Nike", "Adidas", "Puma", "Reebok", "New Balance"]
+SEED_CATEGORIES = ["shoes", "hoodie", "t-shirt", "hat", "backpack"]
+SEED_COLORS = ["black", "white", "red", "blue", "green"]
+SEED_EVENTS = ["restock", "sale", "price_update"]
+SEED_EVENT_WEIGHTS = [0.25, 0.6, 0.15]
+
+# Rows handed to each executemany / committed per transaction while seeding
+SEED_BATCH_ROWS = 50_000
+# The NumPy generator draws a fresh stream per block of this many products,
+# so its output does not depend on how rows are batched
+SEED_NUMPY_BLOCK_PRODUCTS = 256
+
+_INSERT_EVENT = """
+    INSERT INTO transactions (
+        product_id, product_name, brand, category, color,
+        action, qty_delta, unit_price, notes
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
 def create_transactions_db(
     db_name: str = "products.db",
     n_products: int = 100,
     n_txns_per_product: int = 50,
+    seed: int = 42,
+    vectorized: bool = False,
 ) -> None:
     """
     Create an SQLite DB with a single 'transactions' table (event-sourced).
     All analytics must be derived from this table (no views).
+
+    Events are generated in batches and written with executemany, one
+    transaction per batch, with WAL and synchronous=OFF while loading.
+    The default generator replays the original random.Random(seed) draw order,
+    so the rows are identical to the row-by-row seeding for the same seed.
+    vectorized=True draws with NumPy instead: much faster for load-test sizes
+    and also deterministic per seed, but a different dataset.
     """
+    # Pooled read-only connections must not keep serving the old contents
+    close_pools(db_name)
     conn = sqlite3.connect(db_name)
     cur = conn.cursor()
 
@@ -34,106 +78,550 @@ def create_transactions_db(
         ts DATETIME DEFAULT CURRENT_TIMESTAMP
     )
     """)
+    conn.commit()
+
+    # Bulk-load settings: a crash mid-seed only means seeding again
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=OFF")
+    cur.execute("PRAGMA cache_size=-65536")  # 64 MB
+
+    if vectorized:
+        batches = _numpy_event_batches(n_products, n_txns_per_product, seed)
+    else:
+        batches = _event_batches(n_products, n_txns_per_product, seed)
+    for rows in batches:
+        with conn:
+            conn.executemany(_INSERT_EVENT, rows)
 
-    brands = ["Nike", "Adidas", "Puma", "Reebok", "New Balance"]
-    categories = ["shoes", "hoodie", "t-shirt", "hat", "backpack"]
-    colors = ["black", "white", "red", "blue", "green"]
+    # Back to a single-file database with durable writes for readers
+    cur.execute("PRAGMA journal_mode=DELETE")
+    cur.execute("PRAGMA synchronous=FULL")
+    conn.close()
+
+    print(f"SQLite database '{db_name}' created with a single 'transactions' table (event-sourced).")
 
-    rng = random.Random(42)
+
+def _event_batches(n_products: int, n_txns_per_product: int, seed: int):
+    """Yield lists of event rows, drawing from random.Random(seed) in the original order."""
+    rng = random.Random(seed)
     product_catalog = []
     for pid in range(1, n_products + 1):
-        name = f"{rng.choice(brands)} {rng.choice(categories)}"
+        name = f"{rng.choice(SEED_BRANDS)} {rng.choice(SEED_CATEGORIES)}"
         brand = name.split()[0]
         category = name.split()[1]
-        color = rng.choice(colors)
+        color = rng.choice(SEED_COLORS)
         base_price = round(rng.uniform(20.0, 150.0), 2)
         product_catalog.append((pid, name, brand, category, color, base_price))
 
-    # Seed events per product
+    # Same draws as choices(weights=...), without re-accumulating the weights per event
+    cum_weights = list(itertools.accumulate(SEED_EVENT_WEIGHTS))
+    rows = []
     for (pid, name, brand, category, color, base_price) in product_catalog:
+        product = (pid, name, brand, category, color)
         # Initial insert (with opening stock and price)
         initial_stock = rng.randint(5, 50)
-        cur.execute("""
-            INSERT INTO transactions (
-                product_id, product_name, brand, category, color,
-                action, qty_delta, unit_price, notes
-            ) VALUES (?, ?, ?, ?, ?, 'insert', ?, ?, ?)
-        """, (pid, name, brand, category, color, initial_stock, base_price,
-              f"Initial insert with stock={initial_stock}, price={base_price}"))
+        rows.append((*product, "insert", initial_stock, base_price,
+                     f"Initial insert with stock={initial_stock}, price={base_price}"))
 
         current_price = base_price
 
         # Follow-up events
         for _ in range(n_txns_per_product - 1):
-            event_type = rng.choices(
-                ["restock", "sale", "price_update"],
-                weights=[0.25, 0.6, 0.15],
-                k=1
-            )[0]
+            event_type = rng.choices(SEED_EVENTS, cum_weights=cum_weights, k=1)[0]
 
             if event_type == "restock":
                 qty = rng.randint(1, 25)
-                cur.execute("""
-                    INSERT INTO transactions (
-                        product_id, product_name, brand, category, color,
-                        action, qty_delta, unit_price, notes
-                    ) VALUES (?, ?, ?, ?, ?, 'restock', ?, NULL, ?)
-                """, (pid, name, brand, category, color, qty,
-                      f"Restock +{qty} units"))
+                rows.append((*product, "restock", qty, None, f"Restock +{qty} units"))
 
             elif event_type == "sale":
                 qty = -rng.randint(1, 10)  # negative
-                cur.execute("""
-                    INSERT INTO transactions (
-                        product_id, product_name, brand, category, color,
-                        action, qty_delta, unit_price, notes
-                    ) VALUES (?, ?, ?, ?, ?, 'sale', ?, ?, ?)
-                """, (pid, name, brand, category, color, qty, current_price,
-                      f"Sale {-qty} units at {current_price}"))
+                rows.append((*product, "sale", qty, current_price, f"Sale {-qty} units at {current_price}"))
 
             else:  # price_update
                 delta = round(rng.uniform(-5.0, 5.0), 2)
                 current_price = max(1.0, round(current_price + delta, 2))
-                cur.execute("""
-                    INSERT INTO transactions (
-                        product_id, product_name, brand, category, color,
-                        action, qty_delta, unit_price, notes
-                    ) VALUES (?, ?, ?, ?, ?, 'price_update', 0, ?, ?)
-                """, (pid, name, brand, category, color, current_price,
-                      f"Price update to {current_price}"))
+                rows.append((*product, "price_update", 0, current_price, f"Price update to {current_price}"))
 
-    conn.commit()
-    conn.close()
+        if len(rows) >= SEED_BATCH_ROWS:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def _numpy_event_batches(n_products: int, n_txns_per_product: int, seed: int):
+    """
+    Yield lists of event rows for blocks of SEED_NUMPY_BLOCK_PRODUCTS products.
+    Draws are vectorized across the block; only the price random walk steps
+    through events one column at a time.
+    """
+    import numpy as np
+
+    n_events = n_txns_per_product - 1
+    for block, first in enumerate(range(1, n_products + 1, SEED_NUMPY_BLOCK_PRODUCTS)):
+        rng = np.random.default_rng([seed, block])
+        pids = range(first, min(first + SEED_NUMPY_BLOCK_PRODUCTS, n_products + 1))
+        k = len(pids)
+
+        brands = rng.integers(0, len(SEED_BRANDS), k).tolist()
+        categories = rng.integers(0, len(SEED_CATEGORIES), k).tolist()
+        colors = rng.integers(0, len(SEED_COLORS), k).tolist()
+        base_prices = np.round(rng.uniform(20.0, 150.0, k), 2)
+        initial_stocks = rng.integers(5, 51, k).tolist()
+
+        kinds = rng.choice(len(SEED_EVENTS), size=(k, n_events), p=SEED_EVENT_WEIGHTS)
+        restock_qty = rng.integers(1, 26, (k, n_events))
+        sale_qty = -rng.integers(1, 11, (k, n_events))
+        deltas = np.round(rng.uniform(-5.0, 5.0, (k, n_events)), 2)
+
+        prices = np.empty((k, n_events))
+        current = base_prices.copy()
+        for j in range(n_events):
+            updated = kinds[:, j] == 2
+            current = np.where(updated, np.maximum(1.0, np.round(current + deltas[:, j], 2)), current)
+            prices[:, j] = current
+        qty = np.where(kinds == 0, restock_qty, np.where(kinds == 1, sale_qty, 0))
+
+        kinds, qty, prices, base_prices = kinds.tolist(), qty.tolist(), prices.tolist(), base_prices.tolist()
+        rows = []
+        for i, pid in enumerate(pids):
+            brand, category = SEED_BRANDS[brands[i]], SEED_CATEGORIES[categories[i]]
+            product = (pid, f"{brand} {category}", brand, category, SEED_COLORS[colors[i]])
+            stock, base_price = initial_stocks[i], base_prices[i]
+            rows.append((*product, "insert", stock, base_price,
+                         f"Initial insert with stock={stock}, price={base_price}"))
+            for kind, q, price in zip(kinds[i], qty[i], prices[i]):
+                if kind == 0:
+                    rows.append((*product, "restock", q, None, f"Restock +{q} units"))
+                elif kind == 1:
+                    rows.append((*product, "sale", q, price, f"Sale {-q} units at {price}"))
+                else:
+                    rows.append((*product, "price_update", 0, price, f"Price update to {price}"))
+        yield rows
+
+
+# === Read-only connection pool ===
+# Idle connections kept per database file (more are opened under load and
+# closed when returned to a full pool)
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", "8"))
+# Prepared statements cached per connection by the sqlite3 module
+SQL_CACHED_STATEMENTS = int(os.getenv("SQL_CACHED_STATEMENTS", "256"))
+# Page cache per connection (KiB) and memory-mapped I/O window (bytes)
+SQL_CACHE_KB = int(os.getenv("SQL_CACHE_KB", str(64 * 1024)))
+SQL_MMAP_BYTES = int(os.getenv("SQL_MMAP_BYTES", str(256 * 1024 * 1024)))
+
+
+class ConnectionPool:
+    """
+    Warm read-only connections to one SQLite file, reused across calls and threads.
+
+    Connections are opened with mode=ro and PRAGMA query_only, so generated SQL
+    cannot modify the data. Instead of SQLite's deprecated shared-cache mode,
+    each connection gets a large private page cache plus mmap, so reads after
+    the first come from the OS page cache without copying.
+    """
+
+    def __init__(self, db_path: str, max_idle: int = SQL_POOL_SIZE):
+        self.path = Path(db_path).resolve()
+        self.max_idle = max_idle
+        # Identifies the file the connections were opened on (see get_pool)
+        self.file_id = _file_id(self.path)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            f"{self.path.as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,  # handed to one thread at a time by the pool
+            cached_statements=SQL_CACHED_STATEMENTS,
+        )
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA cache_size=-{SQL_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size={SQL_MMAP_BYTES}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection (most recently used first, so its cache is warm)."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self) -> None:
+        """Close the idle connections; ones still checked out are closed on return."""
+        with self._lock:
+            idle, self._idle, self.max_idle = self._idle, [], 0
+        for conn in idle:
+            conn.close()
+
+
+_pools: dict[Path, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _file_id(path: Path) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """Return the shared pool for db_path, replacing it if the file was deleted or swapped."""
+    path = Path(db_path).resolve()
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is not None and pool.file_id != _file_id(path):
+            pool.close()
+            pool = None
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def close_pools(db_path: str | None = None) -> None:
+    """Close the pool for db_path, or every pool when db_path is None."""
+    with _pools_lock:
+        if db_path is None:
+            pools = list(_pools.values())
+            _pools.clear()
+        else:
+            pool = _pools.pop(Path(db_path).resolve(), None)
+            pools = [pool] if pool is not None else []
+    for pool in pools:
+        pool.close()
+
+
+# === Query result cache ===
+# Set SQL_RESULT_CACHE=0 to always run the query
+SQL_RESULT_CACHE_ENABLED = os.getenv("SQL_RESULT_CACHE", "1") != "0"
+SQL_RESULT_CACHE_ENTRIES = int(os.getenv("SQL_RESULT_CACHE_ENTRIES", "256"))
+SQL_RESULT_CACHE_BYTES = int(os.getenv("SQL_RESULT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# String literals / quoted identifiers, or a run of whitespace and comments
+_SQL_LEXEME = re.compile(
+    r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|((?:\s+|--[^\n]*|/\*.*?\*/)+)""",
+    re.S,
+)
+
+
+# Keywords uppercased by the local tokenizer. SQLite names an unaliased result
+# column after the expression's exact spelling, so results found under a
+# normalized key are relabeled with the query's own headers (_probe_columns)
+_SQL_KEYWORDS = frozenset("""
+    ALL AND AS ASC BETWEEN BY CASE CROSS DESC DISTINCT ELSE END ESCAPE EXCEPT EXISTS FROM FULL GLOB
+    GROUP HAVING IN INNER INTERSECT IS JOIN LEFT LIKE LIMIT NATURAL NOT NULL NULLS OFFSET ON OR ORDER
+    OUTER OVER PARTITION RECURSIVE RIGHT SELECT THEN UNION USING VALUES WHEN WHERE WINDOW WITH
+""".split())
+_SQL_LITERAL = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])""")
+# A word followed by "(" is a function call (or a keyword such as IN); SQLite
+# matches function names case-insensitively, so those are folded as well
+_SQL_WORD = re.compile(r"\b[A-Za-z_]\w*\b(?P<call>(?= ?\())?")
+_SQL_PUNCT = re.compile(r" ?([,()]) ?")
+
+
+def _strip_sql(query: str) -> str:
+    # Markdown fences, comments and runs of whitespace outside literals
+    q = query.strip().removeprefix("```sql").removesuffix("```")
+    q = _SQL_LEXEME.sub(lambda m: m.group(1) or " ", q)
+    return q.strip().rstrip(";").strip()
 
-    print(f"SQLite database '{db_name}' created with a single 'transactions' table (event-sourced).")
+
+def _fold_word(m: re.Match) -> str:
+    word = m.group(0)
+    return word.upper() if m.group("call") is not None or word.upper() in _SQL_KEYWORDS else word
+
+
+def _tokenize_sql(query: str) -> str:
+    def canonical(text: str) -> str:
+        text = _SQL_WORD.sub(_fold_word, text)
+        return _SQL_PUNCT.sub(r"\1", text)
+
+    parts = _SQL_LITERAL.split(query)
+    return "".join(part if i % 2 else canonical(part) for i, part in enumerate(parts))
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(query: str) -> str:
+    """
+    Canonical text of a query, used for cache keys and to tell whether a
+    refined query actually changed.
+
+    Markdown fences and comments are removed, whitespace outside literals is
+    collapsed and trailing semicolons dropped. The rest is re-rendered by
+    sqlglot when it is installed; otherwise keywords and function names are
+    uppercased and spaces around commas and parentheses removed. Literals are
+    never touched.
+    """
+    q = _strip_sql(query)
+    if sqlglot is not None:
+        try:
+            return "; ".join(sqlglot.transpile(q, read="sqlite", write="sqlite"))
+        except sqlglot.errors.SqlglotError:
+            pass  # let SQLite report the error; keep a stable key meanwhile
+    return _tokenize_sql(q)
+
+
+class QueryResultCache:
+    """
+    In-memory LRU of query results, keyed by (database file, data version,
+    normalized SQL) and bounded by entry count and DataFrame memory.
+
+    The data version is PRAGMA schema_version plus max(id) of 'transactions'
+    (see _data_version): appending events or reseeding the table changes it,
+    and the database's older entries are dropped the first time that is seen.
+    """
+
+    def __init__(self, max_entries: int = SQL_RESULT_CACHE_ENTRIES, max_bytes: int = SQL_RESULT_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, tuple[pd.DataFrame, int]]" = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, db: tuple, version: tuple, sql: str) -> pd.DataFrame | None:
+        """Return a copy of the cached result, or None (dropping stale entries for db)."""
+        with self._lock:
+            if self._versions.get(db) != version:
+                for key in [k for k in self._entries if k[0] == db]:
+                    self._bytes -= self._entries.pop(key)[1]
+                self._versions[db] = version
+            entry = self._entries.get((db, version, sql))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((db, version, sql))
+            self.hits += 1
+            return entry[0].copy()
+
+    def set(self, db: tuple, version: tuple, sql: str, df: pd.DataFrame) -> None:
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        key = (db, version, sql)
+        with self._lock:
+            if self._versions.get(db) != version:
+                return  # data changed while the query ran
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df.copy(), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+result_cache = QueryResultCache()
+
+
+def _data_version(conn: sqlite3.Connection) -> tuple:
+    # Events are append-only, so a new row always raises max(id); rebuilding
+    # the table bumps schema_version even when it ends up with the same ids
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    try:
+        max_id = conn.execute("SELECT max(id) FROM transactions").fetchone()[0]
+    except sqlite3.OperationalError:
+        max_id = None
+    return schema_version, max_id
+
+
+def _probe_columns(conn: sqlite3.Connection, query: str) -> list[str] | None:
+    """
+    Result headers of query as SQLite would name them, without running it:
+    the outer LIMIT 0 stops before the first row. None when the query cannot
+    be wrapped this way or has duplicate headers (SQLite suffixes those ':1').
+    """
+    try:
+        cursor = conn.execute(f"SELECT * FROM (\n{query.rstrip().rstrip(';')}\n) LIMIT 0")
+    except sqlite3.Error:
+        return None
+    columns = [d[0] for d in cursor.description]
+    cursor.close()
+    if len(set(columns)) != len(columns) or any(re.search(r":\d+$", c) for c in columns):
+        return None
+    return columns
+
+
+def query_columns(query: str, db_path: str) -> list[str] | None:
+    """
+    Column headers query would produce on db_path, without running it (see
+    _probe_columns); used to relabel a result reused for an equivalent query.
+    """
+    q = query.strip().removeprefix("```sql").removesuffix("```").strip()
+    with get_pool(db_path).connection() as conn:
+        return _probe_columns(conn, q)
 
 
 def get_schema(db_path: str) -> str:
     """
     Return only the schema that the agent should use: 'transactions' table.
     """
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(transactions)")
-    rows = cur.fetchall()
-    conn.close()
+    with get_pool(db_path).connection() as conn:
+        rows = conn.execute("PRAGMA table_info(transactions)").fetchall()
     return "table name: transactions\n" + "\n".join([f"{r[1]} ({r[2]})" for r in rows])
 
 
-def execute_sql(query: str, db_path: str) -> pd.DataFrame:
+def execute_sql(query: str, db_path: str, use_cache: bool = True) -> pd.DataFrame:
     """
-    Execute any SELECT over the event-sourced 'transactions' table.
+    Execute any SELECT over the event-sourced 'transactions' table,
+    on a pooled read-only connection.
+
+    Results are served from result_cache while the table's data version is
+    unchanged, relabeled with this query's own column headers; errors are
+    never cached.
     """
     q = query.strip().removeprefix("```sql").removesuffix("```").strip()
-    conn = sqlite3.connect(db_path)
+    use_cache = use_cache and SQL_RESULT_CACHE_ENABLED
     try:
-        return pd.read_sql_query(q, conn)
+        pool = get_pool(db_path)
+        with pool.connection() as conn:
+            if not use_cache:
+                return pd.read_sql_query(q, conn)
+            # Read the version and the result from one snapshot
+            conn.execute("BEGIN")
+            db, version, sql = (pool.path, pool.file_id), _data_version(conn), normalize_sql(q)
+            # Equivalent spellings share an entry, but unaliased headers follow the text
+            columns = _probe_columns(conn, q)
+            cached = result_cache.get(db, version, sql) if columns is not None else None
+            if cached is not None and len(cached.columns) == len(columns):
+                cached.columns = columns
+                return cached
+            df = pd.read_sql_query(q, conn)
     except Exception as e:
         return pd.DataFrame({"error": [str(e)]})
-    finally:
-        conn.close()
+    if columns is not None:
+        result_cache.set(db, version, sql, df)
+    return df
+
+
+
+# === Execution feedback for reflection ===
+# Rough prompt budget for the SQL output shown to the reviewer (~4 chars per token)
+SQL_FEEDBACK_TOKEN_BUDGET = int(os.getenv("SQL_FEEDBACK_TOKEN_BUDGET", "2000"))
+# Results longer than this are summarized without rendering the full table first
+SQL_FEEDBACK_MAX_ROWS = int(os.getenv("SQL_FEEDBACK_MAX_ROWS", "200"))
+_CHARS_PER_TOKEN = 4
 
 
+def _format_stat(value, exact: bool) -> str | None:
+    # Integer columns (and their sums) are printed exactly so the reviewer can
+    # check totals and extremes; floats keep 10 significant digits
+    if value is None or pd.isna(value):
+        return None
+    return str(int(value)) if exact else format(float(value), ".10g")
+
+
+def _column_stats(df: pd.DataFrame) -> pd.DataFrame:
+    """Per-column stats, pre-formatted as strings (render with disable_numparse)."""
+    rows = []
+    for col in df.columns:
+        s = df[col]
+        row = {"column": col, "dtype": str(s.dtype), "nulls": str(int(s.isna().sum()))}
+        if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            exact = pd.api.types.is_integer_dtype(s)
+            row.update(
+                min=_format_stat(s.min(), exact),
+                max=_format_stat(s.max(), exact),
+                mean=_format_stat(s.mean(), False),
+                sum=_format_stat(s.sum(), exact),
+            )
+        else:
+            counts = s.astype(str).value_counts(dropna=True)
+            row.update(distinct=str(int(s.nunique())), top=counts.index[0] if len(counts) else None)
+        rows.append(row)
+    stats = pd.DataFrame(rows).astype(object)
+    return stats.where(stats.notna(), None)  # blank, not nan, for stats that don't apply
+
+
+def summarize_result(df: pd.DataFrame, token_budget: int = SQL_FEEDBACK_TOKEN_BUDGET) -> str:
+    """
+    Render a query result for the reflection prompt within token_budget.
+
+    Small results are returned as the full markdown table. Larger ones become
+    shape, per-column dtype / null count / stats, and head and tail samples;
+    the sample shrinks until the text fits, so prompt size stays flat no
+    matter how many rows the query returned.
+    """
+    budget = token_budget * _CHARS_PER_TOKEN
+    if len(df) <= SQL_FEEDBACK_MAX_ROWS:
+        full = df.to_markdown(index=False)
+        if len(full) <= budget:
+            return full
+
+    intro = f"(Result too large to show in full: {len(df)} rows x {len(df.columns)} columns. Summary below.)"
+    stats = _column_stats(df).to_markdown(index=False, disable_numparse=True, missingval="")
+    stats = _fit_table_rows(stats, budget - len(intro) - len("\n\nColumns:\n"), "columns")
+    if stats is None:
+        return intro[:budget]
+    header = f"{intro}\n\nColumns:\n{stats}"
+    n = min(5, (len(df) + 1) // 2)
+    while n > 0:
+        head = df.head(n).to_markdown(index=False)
+        tail = df.tail(n).to_markdown(index=False)
+        text = f"{header}\n\nFirst {n} rows:\n{head}\n\nLast {n} rows:\n{tail}"
+        if len(text) <= budget:
+            return text
+        n //= 2
+    return header
+
+
+def _fit_table_rows(table: str, limit: int, noun: str) -> str | None:
+    """
+    Keep the markdown table's header and as many whole rows as fit in limit
+    characters, noting how many were dropped; None if not even one row fits.
+    """
+    lines = table.split("\n")
+    if len(table) <= limit:
+        return table
+    # Room for the note is reserved up front, sized for the largest possible count
+    reserve = len(f"\n\n(... {len(lines)} more {noun} not shown)")
+    kept, size = lines[:2], len(lines[0]) + 1 + len(lines[1])
+    if size + reserve > limit:
+        return None
+    for line in lines[2:]:
+        if size + 1 + len(line) + reserve > limit:
+            break
+        kept.append(line)
+        size += 1 + len(line)
+    if len(kept) == 2:
+        return None
+    return "\n".join(kept) + f"\n\n(... {len(lines) - len(kept)} more {noun} not shown)"
+
 # ================================
 # Standard library imports
 # ================================
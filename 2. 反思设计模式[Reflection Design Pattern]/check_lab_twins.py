@@ -0,0 +1,61 @@
+"""
+校验图表实验（2.4）与 SQL 实验（2.7）中的同名副本是否一致
+
+每个实验目录都要能单独打开运行（notebook 以实验目录为工作目录，不依赖上级目录），
+所以公共模块在两个实验中各保留一份，而不是通过 sys.path 共享；修改一份后运行本脚本确认另一份已同步
+（fake_llm.py 的模块说明与脚本化回复按实验定制，不参与比较）：
+    python check_lab_twins.py
+
+不一致时打印 diff 并以非零状态码退出。
+"""
+
+import sys
+import difflib
+from pathlib import Path
+
+CHAPTER_DIR = Path(__file__).resolve().parent
+CHART_LAB = CHAPTER_DIR / "2.4 无评分实验-图表生成[Ungraded Lab- Chart Generation]"
+SQL_LAB = CHAPTER_DIR / "2.7 无评分实验-用反思改进SQL生成[Ungraded Lab- Improving SQL Generation with Reflection]"
+
+# 两个实验中必须逐字相同的文件
+IDENTICAL_FILES = ("tracing.py",)
+# 文件 -> 允许不同的部分：模块说明之外，只有以 BANNER 包围的这些小节按实验定制
+TWIN_FILES = {"fake_llm.py": ("脚本化回复",)}
+
+BANNER = "# " + "-" * 70
+
+
+def _shared_part(text: str, sections: tuple) -> str:
+    """去掉模块说明与按实验定制的小节，只留两份应当相同的部分；sections 为空时原样返回。"""
+    if sections and text.startswith('"""'):
+        text = text[text.index('"""', 3) + 3:]
+    for title in sections:
+        start = text.index(f"{BANNER}\n# {title}\n{BANNER}\n")
+        end = text.index(BANNER, start + 2 * len(BANNER) + len(title))
+        text = text[:start] + f"{BANNER}\n# {title}（按实验定制，不比较）\n" + text[end:]
+    return text
+
+
+def compare(name: str, sections: tuple = ()) -> list[str]:
+    """返回两份副本（去掉可不同的部分后）的 unified diff 行，一致时为空列表。"""
+    chart = _shared_part((CHART_LAB / name).read_text(encoding="utf-8"), sections).splitlines(keepends=True)
+    sql = _shared_part((SQL_LAB / name).read_text(encoding="utf-8"), sections).splitlines(keepends=True)
+    return list(difflib.unified_diff(chart, sql, f"2.4/{name}", f"2.7/{name}"))
+
+
+def main() -> int:
+    failed = 0
+    checks = [(name, ()) for name in IDENTICAL_FILES] + list(TWIN_FILES.items())
+    for name, sections in checks:
+        diff = compare(name, sections)
+        if diff:
+            failed += 1
+            print(f"❌ {name} 两份副本不一致：")
+            sys.stdout.writelines(diff)
+        else:
+            print(f"✅ {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())